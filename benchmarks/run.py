@@ -0,0 +1,281 @@
+"""Time the hot paths on synthetic data.
+
+Every benchmark runs in a fresh child process, so its peak memory is its own.
+Results are written as JSON, and a previous results file can be given to
+print the change of every benchmark.
+
+    python benchmarks/run.py --scale small --out results.json
+    python benchmarks/run.py --scale medium --compare results.json
+"""
+from __future__ import print_function
+
+import argparse
+import imp
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'bin'))
+sys.path.insert(0, ROOT)
+
+from synthetic import START, generate
+
+# stations, days of hourly data, shoreline features, queries
+SCALES = {
+    'small': (50, 60, 5000, 1000),
+    'medium': (300, 365, 50000, 10000),
+    'large': (1000, 730, 200000, 50000),
+}
+
+DB_MODES = ('disk', 'readonly', 'immutable', 'memory')
+
+
+def _task():
+    """shoreline-task.py, which cannot be imported by name.
+    """
+    return imp.load_source('shoreline_task',
+                           os.path.join(ROOT, 'bin', 'shoreline-task.py'))
+
+
+def _queries(ctx, seed=1):
+    rng = random.Random(seed)
+    lats = [rng.uniform(-70, 70) for _ in range(ctx['queries'])]
+    lons = [rng.uniform(-180, 180) for _ in range(ctx['queries'])]
+    dtgs = [(START + timedelta(minutes=rng.randint(0, 60 * 24 * 365)))
+            .strftime('%Y-%m-%d-%H-%M') for _ in range(ctx['queries'])]
+    return lats, lons, dtgs
+
+
+def _warm_task(ctx):
+    st = _task()
+    st.DB_FILE = ctx['db']
+    st.TIDE_MODEL_FILE = ctx['store']
+    st.warm_up()
+    st.PREDICTION_CACHE.clear()
+    return st
+
+
+# Each benchmark is a setup, which is not timed, and a run of that state
+# returning the number of items processed.
+
+def ingest_stations(ctx):
+    from data.to_db_station import to_db_station
+    return lambda: to_db_station(ctx['db'], ctx['stations']) or ctx['stations_count']
+
+
+def ingest_gauges(ctx):
+    from data.to_db_fhd import to_db_fhd
+    return lambda: to_db_fhd(ctx['db'], ctx['gauges']) or ctx['rows']
+
+
+def init_db(mode):
+    def setup(ctx):
+        st = _task()
+        return lambda: st.init_db(ctx['db'], mode=mode).execute(
+            'select count(*) from fdh').fetchone()[0]
+    setup.__name__ = 'init_db_%s' % mode
+    return setup
+
+
+def build_tide_models(ctx):
+    st = _task()
+    st.DB_FILE = ctx['db']
+    if os.path.exists(ctx['store']):
+        shutil.rmtree(ctx['store'])
+
+    def run():
+        return len(st.build_tide_models(ctx['store']))
+    return run
+
+
+def load_tide_models(ctx):
+    st = _task()
+
+    def run():
+        return len(st.build_tide_models(ctx['store']).engine())
+    return run
+
+
+def nearest_station(ctx):
+    st = _warm_task(ctx)
+    lats, lons, _ = _queries(ctx)
+    return lambda: len([st.nearest_station(lat, lon)
+                        for (lat, lon) in zip(lats, lons)])
+
+
+def nearest_stations(ctx):
+    st = _warm_task(ctx)
+    lats, lons, _ = _queries(ctx)
+    return lambda: len(st.nearest_stations(lats, lons))
+
+
+def predict_tides(ctx):
+    st = _warm_task(ctx)
+    _, _, dtgs = _queries(ctx)
+    stations = st.get_tide_engine().stations
+    stations = [stations[i % len(stations)] for i in range(len(dtgs))]
+    return lambda: len([st.predict_tides(station, dtg)
+                        for (station, dtg) in zip(stations, dtgs)])
+
+
+def tide_coordination_batch(ctx):
+    st = _warm_task(ctx)
+    lats, lons, dtgs = _queries(ctx)
+    return lambda: len(st.tide_coordination_batch(lats, lons, dtgs))
+
+
+def enrich(mode):
+    def setup(ctx):
+        from geojson_stream import enrich
+        record = {'identifier': 'synthetic',
+                  'properties': dict(('key%d' % i, 'value' * 20)
+                                     for i in range(60))}
+        tides = {'minimumTide24Hours': 0.5, 'maximumTide24Hours': 1.5,
+                 'currentTide': 1.0}
+        out_file = ctx['shorelines'] + '.out'
+        return lambda: enrich(ctx['shorelines'], out_file, record, tides, mode)
+    setup.__name__ = 'enrich_%s' % mode
+    return setup
+
+
+BENCHMARKS = ([ingest_stations, ingest_gauges] +
+              [init_db(mode) for mode in DB_MODES] +
+              [build_tide_models, load_tide_models, nearest_station,
+               nearest_stations, predict_tides, tide_coordination_batch] +
+              [enrich(mode) for mode in ('full', 'reference')])
+
+
+def _child(benchmark, ctx, results):
+    try:
+        run = benchmark(ctx)
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        cpu = time.clock() if sys.version_info[0] < 3 else time.process_time()
+        start = time.time()
+        items = run()
+        seconds = time.time() - start
+        cpu = ((time.clock() if sys.version_info[0] < 3
+                else time.process_time()) - cpu)
+        results.put({
+            'seconds': seconds,
+            'cpu_seconds': cpu,
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss,
+            'items': items,
+            'ms_per_item': 1000 * seconds / max(items, 1),
+            'error': None
+        })
+    except Exception as e:
+        results.put({'error': '%s: %s' % (type(e).__name__, e)})
+
+
+def measure(benchmark, ctx):
+    """Run one benchmark in a child process.
+    :returns: Dict -- seconds, cpu_seconds, peak_rss_kb (growth while
+        running), items, ms_per_item, error
+    """
+    results = multiprocessing.Queue()
+    child = multiprocessing.Process(target=_child,
+                                    args=(benchmark, ctx, results))
+    child.start()
+    result = results.get()
+    child.join()
+    return result
+
+
+def _revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=ROOT).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous):
+    """Print the change of every benchmark against a previous run.
+    """
+    before = dict((r['name'], r) for r in previous['results'])
+    print('%-28s %10s %10s %8s' % ('benchmark', 'before s', 'after s', 'ratio'))
+    for r in results['results']:
+        old = before.get(r['name'])
+        if old is None or r.get('error') or old.get('error'):
+            continue
+        print('%-28s %10.3f %10.3f %8.2f' % (r['name'], old['seconds'],
+                                              r['seconds'],
+                                              r['seconds'] / old['seconds']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths.')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--out', default='benchmark-results.json',
+                        help='JSON results file to write')
+    parser.add_argument('--compare', help='previous results file')
+    parser.add_argument('--only', nargs='*',
+                        help='run only these benchmarks (ingest always runs)')
+    parser.add_argument('--workdir', help='keep the synthetic data here')
+    args = parser.parse_args()
+
+    stations, days, features, queries = SCALES[args.scale]
+    workdir = args.workdir or tempfile.mkdtemp(prefix='shoreline-bench-')
+    try:
+        print('Generating %d stations, %d days, %d features in %s' %
+              (stations, days, features, workdir))
+        ctx = generate(workdir, stations, days, features)
+        ctx.update({
+            'db': os.path.join(workdir, 'fdh.sqlite'),
+            'store': os.path.join(workdir, 'tidemodel'),
+            'stations_count': stations,
+            'queries': queries
+        })
+        if os.path.exists(ctx['db']):
+            os.remove(ctx['db'])
+
+        results = {
+            'revision': _revision(),
+            'date': datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': multiprocessing.cpu_count(),
+            'scale': {'name': args.scale, 'stations': stations, 'days': days,
+                      'features': features, 'queries': queries},
+            'results': []
+        }
+
+        for benchmark in BENCHMARKS:
+            name = benchmark.__name__
+            if (args.only and name not in args.only and
+                    not name.startswith('ingest')):
+                continue
+            result = measure(benchmark, ctx)
+            result['name'] = name
+            results['results'].append(result)
+            if result['error']:
+                print('%-28s failed, %s' % (name, result['error']))
+            else:
+                print('%-28s %9.3fs %9.3fs cpu %9d kB %10.4f ms/item' %
+                      (name, result['seconds'], result['cpu_seconds'],
+                       result['peak_rss_kb'], result['ms_per_item']))
+
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('Wrote', args.out)
+
+        if args.compare:
+            with open(args.compare) as f:
+                compare(results, json.load(f))
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
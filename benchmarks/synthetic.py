@@ -0,0 +1,124 @@
+"""Synthetic inputs at any scale for the benchmarks.
+
+Station lists and hourly gauge CSVs in the layouts data/to_db_station.py and
+data/to_db_fhd.py ingest, and shoreline GeoJSON shaped like bfalg-ndwi
+output.
+
+    python synthetic.py outdir --stations 300 --days 365 --features 50000
+"""
+from __future__ import print_function
+
+import argparse
+import csv
+import json
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+
+# Speeds in degrees per hour of M2, S2, K1 and O1, which the synthetic tides
+# are made of.
+SPEEDS = np.array([28.9841042, 30.0, 15.0410686, 13.9430356])
+
+START = datetime(2015, 1, 1)
+
+
+def station_file(i):
+    """Data file name of station i. to_db_* drop the first three characters
+    for the id, which sqlite then stores as the integer i.
+    """
+    return 'fdh%04d.csv' % i
+
+
+def write_stations(directory, stations, seed=0):
+    """One station list CSV of random stations.
+    :returns: (lats, lons) arrays
+    """
+    rng = np.random.RandomState(seed)
+    lats = np.degrees(np.arcsin(rng.uniform(-0.94, 0.94, stations)))
+    lons = rng.uniform(-180, 180, stations)
+
+    with open(os.path.join(directory, 'stations.csv'), 'w') as f:
+        writer = csv.writer(f)
+        for i in range(stations):
+            writer.writerow(['', '', '', '', '', '%.4f' % lats[i],
+                             '%.4f' % lons[i], station_file(i)])
+
+    return lats, lons
+
+
+def write_gauges(directory, stations, days, seed=0, start=START):
+    """Hourly gauge CSVs, a mean level plus four constituents and noise.
+    :returns: number of rows written
+    """
+    rng = np.random.RandomState(seed)
+    hours = np.arange(24 * days)
+    times = [start + timedelta(hours=int(h)) for h in hours]
+    stamps = [(t.year, t.month, t.day, t.hour) for t in times]
+
+    for i in range(stations):
+        amplitude = rng.uniform(50, 1200, len(SPEEDS))
+        phase = rng.uniform(0, 360, len(SPEEDS))
+        mm = (rng.uniform(1000, 3000) +
+              np.dot(amplitude, np.cos(np.radians(
+                  np.outer(SPEEDS, hours) - phase[:, np.newaxis]))) +
+              rng.normal(0, 30, len(hours)))
+
+        with open(os.path.join(directory, station_file(i)), 'w') as f:
+            writer = csv.writer(f)
+            for stamp, level in zip(stamps, mm):
+                writer.writerow(stamp + (int(round(level)),))
+
+    return stations * len(hours)
+
+
+def write_shorelines(path, features, vertices=50, seed=0):
+    """A FeatureCollection of random line strings, like bfalg-ndwi output.
+    """
+    rng = np.random.RandomState(seed)
+    with open(path, 'w') as f:
+        f.write('{"type": "FeatureCollection", "features": [\n')
+        for i in range(features):
+            start = rng.uniform([-158.0, 21.0], [-157.0, 22.0])
+            line = start + np.cumsum(rng.normal(0, 1e-4, (vertices, 2)),
+                                     axis=0)
+            f.write(json.dumps({
+                'type': 'Feature', 'properties': {},
+                'geometry': {'type': 'LineString',
+                             'coordinates': line.round(7).tolist()}}))
+            f.write(',\n' if i < features - 1 else '\n')
+        f.write(']}\n')
+
+
+def generate(directory, stations=50, days=60, features=5000, seed=0):
+    """Write every synthetic input under directory.
+    :returns: Dict -- stations, gauges and shorelines paths, plus counts
+    """
+    paths = {
+        'stations': os.path.join(directory, 'stations'),
+        'gauges': os.path.join(directory, 'gauges'),
+        'shorelines': os.path.join(directory, 'bf.geojson')
+    }
+    for key in ('stations', 'gauges'):
+        if not os.path.isdir(paths[key]):
+            os.makedirs(paths[key])
+
+    write_stations(paths['stations'], stations, seed)
+    paths['rows'] = write_gauges(paths['gauges'], stations, days, seed)
+    write_shorelines(paths['shorelines'], features, seed=seed)
+    paths['features'] = features
+
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write synthetic inputs.')
+    parser.add_argument('directory')
+    parser.add_argument('--stations', type=int, default=50)
+    parser.add_argument('--days', type=int, default=60)
+    parser.add_argument('--features', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    print(generate(args.directory, args.stations, args.days, args.features,
+                   args.seed))
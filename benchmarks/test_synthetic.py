@@ -0,0 +1,22 @@
+import json
+import sqlite3
+
+import data.to_db_fhd as to_db_fhd
+import data.to_db_station as to_db_station
+from synthetic import generate
+
+
+def test_generate_ingests(tmpdir):
+    paths = generate(str(tmpdir), stations=12, days=2, features=7)
+    db = str(tmpdir.join('fdh.sqlite'))
+
+    to_db_station.to_db_station(db, paths['stations'])
+    to_db_fhd.to_db_fhd(db, paths['gauges'])
+
+    conn = sqlite3.connect(db)
+    assert conn.execute('select count(distinct station) from stations').fetchone() == (12,)
+    assert conn.execute('select count(*) from fdh').fetchone() == (paths['rows'],)
+    assert paths['rows'] == 12 * 48
+
+    shorelines = json.load(open(paths['shorelines']))
+    assert len(shorelines['features']) == 7
@@ -0,0 +1,99 @@
+"""GBDX catalog records, with retries and an on-disk cache.
+
+One session is kept per client, so successive requests reuse the pooled
+connection.  Records are cached as JSON files keyed by catalog id, a record
+never changes once it is in the catalog.
+"""
+from __future__ import print_function
+
+import json
+import os
+import re
+import tempfile
+import time
+
+import requests
+
+CATALOG_URL = 'https://geobigdata.io/catalog/v2/record/%s'
+
+# Cached records, set SHORELINE_CATALOG_CACHE to an empty string to disable.
+CACHE_DIR = os.environ.get('SHORELINE_CATALOG_CACHE',
+                           os.path.join(tempfile.gettempdir(),
+                                        'shoreline-catalog'))
+
+# Responses worth retrying, anything else is returned or raised at once.
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+class CatalogClient(object):
+    """Fetches catalog records by id.
+    """
+
+    def __init__(self, session=None, url=CATALOG_URL, cache_dir=CACHE_DIR,
+                 retries=3, backoff=0.5, timeout=30):
+        """
+        :param session: requests session, e.g. from gbdx_auth (default: an
+            anonymous session)
+        :param url: record URL with a %s for the catalog id
+        :param cache_dir: directory of cached records, None to disable
+        :param retries: attempts after the first one
+        :param backoff: seconds before the first retry, doubled every retry
+        :param timeout: seconds to wait for a response
+        """
+        self.session = session or requests.Session()
+        self.url = url
+        self.cache_dir = cache_dir or None
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+    def record(self, cat_id):
+        """The catalog record of an image, from the cache when present.
+        :param cat_id: catalog id
+        :returns: the record -- json
+        :raises requests.HTTPError: once the retries are used up
+        """
+        cached = self._cache_file(cat_id)
+        if cached is not None and os.path.exists(cached):
+            with open(cached) as f:
+                return json.load(f)
+
+        record = self._get(self.url % cat_id).json()
+
+        if cached is not None:
+            # Write then rename, so a concurrent reader never sees half a
+            # record.
+            if not os.path.isdir(self.cache_dir):
+                try:
+                    os.makedirs(self.cache_dir)
+                except OSError:
+                    pass
+            handle, tmp = tempfile.mkstemp(dir=self.cache_dir)
+            with os.fdopen(handle, 'w') as f:
+                json.dump(record, f)
+            os.rename(tmp, cached)
+
+        return record
+
+    def _get(self, url):
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            try:
+                r = self.session.get(url, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if last:
+                    raise
+                print('Catalog request failed (%s), retrying' % e)
+            else:
+                if r.status_code not in RETRY_STATUS or last:
+                    r.raise_for_status()
+                    return r
+                print('Catalog returned %d, retrying' % r.status_code)
+
+            time.sleep(self.backoff * 2 ** attempt)
+
+    def _cache_file(self, cat_id):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir,
+                            re.sub(r'[^\w.-]', '_', cat_id) + '.json')
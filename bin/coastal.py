@@ -0,0 +1,178 @@
+"""Skip the tiles of a scene that cannot contain a shoreline.
+
+A decimated read of the green and NIR bands of every tile is taken before
+NDWI, and a tile without a single valid pixel is skipped.  Two further
+checks are off unless configured, as either can drop a tile with a real
+shoreline:
+
+- water, when SHORELINE_MIN_WATER_FRACTION is set: the NDWI of the decimated
+  read has to show at least MIN_FRACTION of both water and land.  It uses a
+  fixed threshold on raw values where bfalg-ndwi takes an Otsu threshold,
+  and a thin strip of coast may be only a few decimated pixels.
+- proximity, when SHORELINE_COASTAL_KM is set: tide stations are on the
+  coast, so a tile further than COASTAL_DISTANCE from every station is inland
+  or open ocean.  Gauges are hundreds of kilometres apart on most coasts, so
+  the radius has to be at least their spacing; a coastline dataset would be
+  needed to make it a safe default.
+
+A tile is kept whenever a check cannot be made.
+"""
+import os
+
+import numpy as np
+from shapely.geometry import Polygon
+
+from ndwi_blocks import ndwi_index
+from station_index import EARTH_RADIUS, to_xyz
+
+# Set SHORELINE_PREFILTER to 0 to process every tile.
+PREFILTER = os.environ.get('SHORELINE_PREFILTER', '1') != '0'
+
+# Tiles further than this from every station (km) are skipped, None to keep
+# them all.
+COASTAL_DISTANCE = os.environ.get('SHORELINE_COASTAL_KM')
+COASTAL_DISTANCE = float(COASTAL_DISTANCE) if COASTAL_DISTANCE else None
+
+# Longest side of the decimated read, in pixels.
+OVERVIEW_SIZE = 256
+
+# NDWI above this is water; a tile needs at least MIN_FRACTION of its valid
+# pixels on either side, None to keep tiles whatever their fractions.
+WATER_THRESHOLD = 0.0
+MIN_FRACTION = os.environ.get('SHORELINE_MIN_WATER_FRACTION')
+MIN_FRACTION = float(MIN_FRACTION) if MIN_FRACTION else None
+
+
+def raster_footprint(filename):
+    """Bounds of a raster in longitude and latitude.
+    :returns: shapely Polygon
+    """
+    from osgeo import gdal, osr
+
+    dataset = gdal.Open(filename)
+    if dataset is None:
+        raise IOError('Cannot open %s' % filename)
+    t = dataset.GetGeoTransform()
+    xsize, ysize = dataset.RasterXSize, dataset.RasterYSize
+
+    source = osr.SpatialReference(wkt=dataset.GetProjection())
+    target = osr.SpatialReference()
+    target.ImportFromEPSG(4326)
+    for srs in (source, target):
+        if hasattr(srs, 'SetAxisMappingStrategy'):
+            srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    to_lonlat = osr.CoordinateTransformation(source, target)
+
+    corners = [(t[0] + col * t[1] + row * t[2], t[3] + col * t[4] + row * t[5])
+               for (col, row) in ((0, 0), (xsize, 0), (xsize, ysize),
+                                  (0, ysize))]
+    return Polygon([p[:2] for p in to_lonlat.TransformPoints(corners)])
+
+
+def near_station(footprint, station_index, distance):
+    """Whether a station may lie within distance km of a footprint.
+    Measured from the centroid, widened by the distance to the furthest
+    corner, so it errs towards keeping a tile.
+    :param footprint: shapely geometry in longitude and latitude
+    :param station_index: StationIndex
+    """
+    centroid = footprint.centroid
+    lons, lats = footprint.envelope.exterior.coords.xy
+    cosines = np.dot(to_xyz(lats, lons), to_xyz([centroid.y], [centroid.x])[0])
+    radius = np.arccos(np.clip(cosines, -1, 1)).max() * EARTH_RADIUS
+
+    found, _ = station_index.query([centroid.y], [centroid.x],
+                                   max_distance=distance + radius)
+    return bool(found[0, 0] < len(station_index))
+
+
+def water_fraction(green, nir, nodata=0):
+    """Fraction of the valid pixels that are water.
+    :returns: float, None without valid pixels
+    """
+    index, valid = ndwi_index(green, nir, nodata)
+    if not valid.any():
+        return None
+    return float((index[valid] > WATER_THRESHOLD).sum()) / valid.sum()
+
+
+def overview(files, bands, size=OVERVIEW_SIZE):
+    """Decimated green and NIR bands of a tile, see ndwi_blocks.process.
+    :returns: green, nir, nodata
+    """
+    from osgeo import gdal
+
+    arrays = []
+    nodata = None
+    for filename, number in ((files[0], bands[0]), (files[-1], bands[1])):
+        dataset = gdal.Open(filename)
+        if dataset is None:
+            raise IOError('Cannot open %s' % filename)
+        scale = float(size) / max(dataset.RasterXSize, dataset.RasterYSize)
+        band = dataset.GetRasterBand(number)
+        arrays.append(band.ReadAsArray(
+            buf_xsize=max(1, int(dataset.RasterXSize * min(scale, 1))),
+            buf_ysize=max(1, int(dataset.RasterYSize * min(scale, 1)))))
+        if nodata is None:
+            nodata = band.GetNoDataValue()
+
+    return arrays[0], arrays[1], 0 if nodata is None else nodata
+
+
+def _water_reason(files, bands, min_fraction):
+    """Why the water check skips a tile.
+    :returns: String, None to keep the tile
+    """
+    try:
+        fraction = water_fraction(*overview(files, bands))
+    except Exception:
+        return None
+
+    if fraction is None:
+        return 'no data'
+    if min_fraction is not None:
+        if fraction < min_fraction:
+            return 'no water'
+        if fraction > 1 - min_fraction:
+            return 'no land'
+    return None
+
+
+def prefilter(tiles, bands, station_index, footprint=None,
+              distance=COASTAL_DISTANCE, min_fraction=MIN_FRACTION):
+    """The tiles that may contain a shoreline.
+    :param tiles: List -- [[filename, ...], ...], the input files of each tile
+    :param bands: band numbers of the green and NIR bands
+    :param station_index: StationIndex
+    :param footprint: scene footprint, used for tiles whose bounds cannot be
+        read
+    :param distance: km from a station beyond which tiles are skipped, None
+        for no proximity check
+    :param min_fraction: least fraction of water and of land a tile needs,
+        None for no water check
+    :returns: kept tiles, skipped tiles -- List, List of {'tile', 'reason'}
+    """
+    kept = []
+    skipped = []
+    for files in tiles:
+        bounds = None
+        if distance is not None:
+            try:
+                bounds = raster_footprint(files[0])
+            except Exception:
+                bounds = footprint
+
+        reason = None
+        if bounds is not None and not near_station(bounds, station_index,
+                                                   distance):
+            reason = 'no station within %g km' % distance
+        else:
+            reason = _water_reason(files, bands, min_fraction)
+
+        if reason is None:
+            kept.append(files)
+        else:
+            skipped.append({'tile': os.path.basename(files[0]),
+                            'reason': reason})
+
+    return kept, skipped
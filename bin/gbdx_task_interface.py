@@ -11,6 +11,7 @@ class GbdxTaskInterface(object):
         self._string_input_ports = None
         self._string_output_ports = None
         self._runtime_info = None
+        self._status_info = {}
         self._reason = None
         self._status = "success"
 
@@ -124,6 +125,14 @@ class GbdxTaskInterface(object):
 
         self._string_output_ports[port_name] = value
 
+    def set_status_info(self, key, value):
+        """
+        Add a value to status.json, next to status and reason
+        :param key:
+        :param value: json serializable value
+        """
+        self._status_info[key] = value
+
     def invoke(self):
         """
         The do something method
@@ -142,7 +151,8 @@ class GbdxTaskInterface(object):
                 json.dump(self._string_output_ports, opf, indent=4)
 
         with open(os.path.join(self.base_path, 'status.json'), 'w') as sf:
-            json.dump({'status': success_or_fail, 'reason': message}, sf, indent=4)
+            json.dump(dict(self._status_info, status=success_or_fail, reason=message),
+                      sf, indent=4)
 
     def __enter__(self):
         return self
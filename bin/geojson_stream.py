@@ -0,0 +1,218 @@
+"""Read and write GeoJSON FeatureCollections one feature at a time.
+
+Only the feature being processed is held in memory, so rewriting a collection
+of any number of features takes memory proportional to the largest feature.
+"""
+import json
+
+# Characters read from the input at a time.
+BUFFER_SIZE = 1 << 16
+
+# How the catalog record and tides are attached to the shorelines:
+#   full        the record and tides as the properties of every feature
+#   reference   the tides and the catalog id on every feature, the record
+#               once on the collection
+#   collection  the record and tides once on the collection, the feature
+#               properties are left as they are
+METADATA_MODES = ('full', 'reference', 'collection')
+
+
+class _Reader(object):
+    """Decodes consecutive JSON values from a buffered file.
+    """
+
+    def __init__(self, f):
+        self._file = f
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self):
+        data = self._file.read(BUFFER_SIZE)
+        if not data:
+            self._eof = True
+            return False
+        self._buffer = self._buffer[self._pos:] + data
+        self._pos = 0
+        return True
+
+    def peek(self):
+        """The next character that is not whitespace, or '' at the end.
+        """
+        while True:
+            while (self._pos < len(self._buffer) and
+                   self._buffer[self._pos] in ' \t\n\r'):
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, characters):
+        c = self.peek()
+        if c not in characters:
+            raise ValueError('Expected one of %r, found %r' % (characters, c))
+        self._pos += 1
+        return c
+
+    def value(self):
+        """Decode the next value, reading more until it is complete.
+        A value that ends with the buffer may continue past it (a number), so
+        it is only accepted at the end of the file.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+                if end < len(self._buffer) or self._eof:
+                    self._pos = end
+                    return value
+            except ValueError:
+                if self._eof:
+                    raise
+            self._fill()
+
+
+def iter_features(f, members=None):
+    """Stream the features of a FeatureCollection.
+    :param f: file object open for reading
+    :param members: Dict, filled with the collection's other members as they
+        are read; complete once the generator is exhausted
+    :returns: generator of features
+    """
+    if members is None:
+        members = {}
+
+    reader = _Reader(f)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+
+    while True:
+        key = reader.value()
+        reader.expect(':')
+        if key == 'features':
+            reader.expect('[')
+            if reader.peek() == ']':
+                reader.expect(']')
+            else:
+                while True:
+                    yield reader.value()
+                    if reader.expect(',]') == ']':
+                        break
+        else:
+            members[key] = reader.value()
+
+        if reader.expect(',}') == '}':
+            return
+
+
+def write_collection(f, features, members=None):
+    """Write a FeatureCollection, one feature at a time.
+    The other members are written after the features, so they may be filled
+    in while the features are generated.
+    :param f: file object open for writing
+    :param features: iterable of features
+    :param members: Dict -- other members of the collection
+    :returns: number of features written
+    """
+    f.write('{"type": "FeatureCollection", "features": [')
+
+    count = 0
+    for feature in features:
+        if count:
+            f.write(',')
+        f.write('\n')
+        f.write(json.dumps(feature))
+        count += 1
+
+    f.write('\n]')
+    for key, value in sorted((members or {}).items()):
+        if key not in ('type', 'features'):
+            f.write(', %s: %s' % (json.dumps(key), json.dumps(value)))
+    f.write('}\n')
+
+    return count
+
+
+def _vertices(coordinates):
+    """The positions of any geometry's nested coordinates.
+    """
+    if coordinates and isinstance(coordinates[0], (int, float)):
+        yield coordinates
+        return
+    for part in coordinates or []:
+        for position in _vertices(part):
+            yield position
+
+
+def centroids(in_file):
+    """Mean vertex of every feature of a FeatureCollection, streaming.
+    Features without a geometry have a NaN centroid.
+    :returns: latitudes, longitudes -- lists of float, in feature order
+    """
+    lats = []
+    lons = []
+    with open(in_file) as f:
+        for feature in iter_features(f):
+            geometry = feature.get('geometry') or {}
+            positions = list(_vertices(geometry.get('coordinates')))
+            if positions:
+                n = float(len(positions))
+                lons.append(sum(p[0] for p in positions) / n)
+                lats.append(sum(p[1] for p in positions) / n)
+            else:
+                lons.append(float('nan'))
+                lats.append(float('nan'))
+
+    return lats, lons
+
+
+def enrich(in_file, out_file, metadata, tides, mode='full',
+           feature_tides=None):
+    """Attach the catalog record and tides to every shoreline of a
+    FeatureCollection, streaming from in_file to out_file.
+    :param metadata: the catalog record -- json
+    :param tides: the tide data -- json
+    :param mode: one of METADATA_MODES
+    :param feature_tides: optional tide data of each feature, in feature
+        order, replacing tides on the features; with the collection mode
+        it is added to the feature properties
+    :returns: number of features written
+    """
+    if mode not in METADATA_MODES:
+        raise ValueError('Unknown metadata mode %s, expected one of %s' %
+                         (mode, ', '.join(METADATA_MODES)))
+
+    result = {'metadata': metadata, 'tides': tides}
+    members = {}
+    collection = {}
+
+    if mode == 'full':
+        def properties(_):
+            return result
+    elif mode == 'reference':
+        reference = {'catalog_id': metadata.get('identifier'), 'tides': tides}
+        collection['properties'] = result
+
+        def properties(_):
+            return reference
+    else:
+        collection['properties'] = result
+
+        def properties(old):
+            return old
+
+    def features(f):
+        for i, feature in enumerate(iter_features(f, members)):
+            feature['properties'] = properties(feature.get('properties'))
+            if feature_tides is not None:
+                feature['properties'] = dict(feature['properties'] or {},
+                                             tides=feature_tides[i])
+            yield feature
+        members.update(collection)
+
+    with open(in_file) as f:
+        with open(out_file, 'w') as out:
+            return write_collection(out, features(f), members)
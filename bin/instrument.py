@@ -0,0 +1,105 @@
+"""Wall time, CPU time and memory of named stages.
+
+    with stage('ndwi'):
+        ...
+
+Records are kept in STAGES and written to status.json by the task.  CPU
+time and peak memory are those of the whole process, so stages running at
+the same time on different threads share them; the CPU time of child
+processes, such as the NDWI pool, is counted separately.
+"""
+import cProfile
+import functools
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+# Write a cProfile dump of the run to this file.
+PROFILE_ENV = 'SHORELINE_PROFILE'
+
+
+def _usage():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (time.time(), own.ru_utime + own.ru_stime,
+            children.ru_utime + children.ru_stime, own.ru_maxrss)
+
+
+class Stages(object):
+    """Measurements of stages, in the order they finished.
+    """
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, **labels):
+        """Measure the enclosed block, recorded even if it raises.
+        :param name: stage name
+        :param labels: further values for the record, e.g. scene=cat_id
+        """
+        wall, cpu, children, rss = _usage()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            end = _usage()
+            record = {
+                'stage': name,
+                'seconds': end[0] - wall,
+                'cpu_seconds': end[1] - cpu,
+                'children_cpu_seconds': end[2] - children,
+                'peak_rss_kb': end[3],
+                'rss_growth_kb': end[3] - rss,
+                'failed': failed
+            }
+            record.update(labels)
+            with self._lock:
+                self.records.append(record)
+
+    def timed(self, name):
+        """Decorator measuring every call of a function.
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def report(self):
+        """
+        :returns: List -- [{'stage', 'seconds', 'cpu_seconds',
+            'children_cpu_seconds', 'peak_rss_kb', 'rss_growth_kb',
+            'failed', labels...}, ...]
+        """
+        with self._lock:
+            return list(self.records)
+
+
+# Stages of this process.
+STAGES = Stages()
+stage = STAGES.stage
+timed = STAGES.timed
+
+
+@contextmanager
+def profiled(filename):
+    """Profile the enclosed block with cProfile, dumping the stats to
+    filename; does nothing when filename is empty.
+    """
+    if not filename:
+        yield
+        return
+
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(filename)
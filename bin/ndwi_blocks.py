@@ -0,0 +1,479 @@
+"""NDWI and shorelines of a scene in fixed size blocks.
+
+The green and NIR bands are read one window at a time, so memory does not
+grow with the size of the scene:
+
+1. Every window's NDWI is written into a tiled GeoTIFF, and a histogram of
+   the index is accumulated for an Otsu threshold over the whole scene.
+2. The NDWI is read back in windows, one pixel wider than the blocks, and
+   the threshold contour of every block is traced with marching squares.
+   Lines that end on a block edge are stitched to their continuation in the
+   neighbouring block, and complete lines have their corners cut.
+
+Both passes fan the windows out over a process pool, a few windows per
+worker at a time.  Contour points are identified by the pixel edge they
+cross, so the two halves of a line meet at exactly the same key on either
+side of a seam.
+"""
+from __future__ import print_function
+
+import multiprocessing
+from collections import deque
+
+import numpy as np
+
+from geojson_stream import write_collection
+
+# Window size in pixels, a multiple of the output tiles.
+BLOCK = 1024
+TILE = 256
+
+NODATA = -9999.0
+
+# Histogram of NDWI values over [-1, 1] used for the Otsu threshold.
+HIST_BINS = 2000
+
+# The smooth value of bfalg-ndwi that leaves no corners, and the rounds of
+# corner cutting that approximate it.
+SMOOTH_MAX = 4 / 3.0
+SMOOTH_ROUNDS = 2
+
+# Pairs of cell edges joined by the contour, by case: top, right, bottom and
+# left corners above the threshold are 8, 4, 2 and 1.  Cases 5 and 10 are
+# saddles, resolved by the mean of the four corners.
+T, R, B, L = range(4)
+SEGMENTS = {
+    1: [(L, B)], 2: [(B, R)], 3: [(L, R)], 4: [(T, R)],
+    6: [(T, B)], 7: [(L, T)], 8: [(L, T)], 9: [(T, B)],
+    11: [(T, R)], 12: [(L, R)], 13: [(B, R)], 14: [(L, B)],
+}
+SADDLES = {
+    # case: (segments if the centre is above, if it is below)
+    5: ([(L, T), (B, R)], [(T, R), (L, B)]),
+    10: ([(T, R), (L, B)], [(L, T), (B, R)]),
+}
+
+# Datasets opened by a pool worker during one process call, by file name.
+_DATASETS = {}
+
+
+def windows(xsize, ysize, block=BLOCK):
+    """Windows covering a raster.
+    :returns: List -- [(xoff, yoff, width, height), ...]
+    """
+    return [(x, y, min(block, xsize - x), min(block, ysize - y))
+            for y in range(0, ysize, block) for x in range(0, xsize, block)]
+
+
+def ndwi_index(green, nir, nodata=0):
+    """Normalized difference water index, (green - nir) / (green + nir).
+    :param nodata: input value marking missing pixels
+    :returns: float32 array with NODATA where undefined, validity mask
+    """
+    green = green.astype(np.float32)
+    nir = nir.astype(np.float32)
+    total = green + nir
+    valid = (green != nodata) & (nir != nodata) & (total != 0)
+
+    index = np.full(green.shape, NODATA, dtype=np.float32)
+    index[valid] = (green[valid] - nir[valid]) / total[valid]
+
+    return index, valid
+
+
+def otsu(histogram, low=-1.0, high=1.0):
+    """Threshold maximizing the between class variance of a histogram.
+    """
+    histogram = np.asarray(histogram, dtype=float)
+    centers = low + (np.arange(len(histogram)) + 0.5) * (high - low) / len(histogram)
+
+    weight = np.cumsum(histogram)
+    mean = np.cumsum(histogram * centers)
+    total = weight[-1]
+    if total == 0:
+        return 0.0
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        between = ((mean[-1] * weight / total - mean) ** 2 /
+                   (weight * (total - weight)))
+    between[~np.isfinite(between)] = -1
+
+    # The edge between the bins is the threshold.
+    return float(centers[np.argmax(between)] + 0.5 * (high - low) / len(histogram))
+
+
+def contour_block(values, threshold, row0, col0, rows, cols, width):
+    """Trace the threshold contour through the cells of one block.
+    :param values: NDWI of the block plus, where the scene continues, one
+        more row and column
+    :param row0: scene row of values[0]
+    :param col0: scene column of values[:, 0]
+    :param rows: rows of cells that belong to the block
+    :param cols: columns of cells that belong to the block
+    :param width: scene width, for edge keys
+    :returns: List -- [(keys, points), ...], one per chain of segments, with
+        the edge key and (row, col) scene position of every point
+    """
+    valid = values != NODATA
+    above = values > threshold
+    rows = min(rows, values.shape[0] - 1)
+    cols = min(cols, values.shape[1] - 1)
+    if rows <= 0 or cols <= 0:
+        return []
+
+    tl = values[:rows, :cols]
+    tr = values[:rows, 1:cols + 1]
+    br = values[1:rows + 1, 1:cols + 1]
+    bl = values[1:rows + 1, :cols]
+    ok = (valid[:rows, :cols] & valid[:rows, 1:cols + 1] &
+          valid[1:rows + 1, 1:cols + 1] & valid[1:rows + 1, :cols])
+    case = (8 * above[:rows, :cols] + 4 * above[:rows, 1:cols + 1] +
+            2 * above[1:rows + 1, 1:cols + 1] + 1 * above[1:rows + 1, :cols])
+    case[~ok] = 0
+    centre = (tl + tr + br + bl) / 4.0 > threshold
+
+    pairs = []
+    for k, segments in SEGMENTS.items():
+        r, c = np.nonzero(case == k)
+        pairs.extend((r, c, a, b) for (a, b) in segments)
+    for k, (if_above, if_below) in SADDLES.items():
+        for mask, segments in ((centre, if_above), (~centre, if_below)):
+            r, c = np.nonzero((case == k) & mask)
+            pairs.extend((r, c, a, b) for (a, b) in segments)
+
+    # Edge keys and crossing points of both ends of every segment.
+    ends = [[], []]
+    for r, c, a, b in pairs:
+        for end, side in zip(ends, (a, b)):
+            end.append(_crossings(values, threshold, r, c, side, row0, col0,
+                                  width))
+    if not ends[0]:
+        return []
+    a_keys, a_rows, a_cols = [np.concatenate(x) for x in zip(*ends[0])]
+    b_keys, b_rows, b_cols = [np.concatenate(x) for x in zip(*ends[1])]
+
+    points = dict(zip(a_keys.tolist(), zip(a_rows.tolist(), a_cols.tolist())))
+    points.update(zip(b_keys.tolist(), zip(b_rows.tolist(), b_cols.tolist())))
+
+    return [(keys, [points[k] for k in keys])
+            for keys in _chains(a_keys.tolist(), b_keys.tolist())]
+
+
+def _crossings(values, threshold, r, c, side, row0, col0, width):
+    """Keys and positions where the contour crosses one side of cells.
+    Horizontal edges join a pixel to its right neighbour, vertical edges to
+    the one below.
+    """
+    if side == T:
+        r0, c0, r1, c1, kind = r, c, r, c + 1, 0
+    elif side == B:
+        r0, c0, r1, c1, kind = r + 1, c, r + 1, c + 1, 0
+    elif side == L:
+        r0, c0, r1, c1, kind = r, c, r + 1, c, 1
+    else:
+        r0, c0, r1, c1, kind = r, c + 1, r + 1, c + 1, 1
+
+    a = values[r0, c0].astype(float)
+    b = values[r1, c1].astype(float)
+    fraction = (threshold - a) / (b - a)
+
+    rows = row0 + r0 + (fraction if kind else 0)
+    cols = col0 + c0 + (0 if kind else fraction)
+    keys = ((row0 + r0).astype(np.int64) * (width + 1) + col0 + c0) * 2 + kind
+
+    return keys, rows, cols
+
+
+def _chains(a_keys, b_keys):
+    """Join segments sharing an edge into chains of edge keys.
+    Every edge is shared by at most two segments.
+    """
+    touching = {}
+    for i, (a, b) in enumerate(zip(a_keys, b_keys)):
+        touching.setdefault(a, []).append(i)
+        touching.setdefault(b, []).append(i)
+
+    used = [False] * len(a_keys)
+
+    def walk(key, segment):
+        keys = []
+        while True:
+            used[segment] = True
+            key = b_keys[segment] if a_keys[segment] == key else a_keys[segment]
+            keys.append(key)
+            following = [s for s in touching[key] if not used[s]]
+            if not following:
+                return keys
+            segment = following[0]
+
+    chains = []
+    for i in range(len(a_keys)):
+        if used[i]:
+            continue
+        forward = walk(a_keys[i], i)
+        backward = [a_keys[i]]
+        following = [s for s in touching[a_keys[i]] if not used[s]]
+        if following:
+            backward = walk(a_keys[i], following[0])[::-1] + backward
+        chains.append(backward + forward)
+
+    return chains
+
+
+class Stitcher(object):
+    """Joins chains that continue across block seams.
+    Chains are held only while one of their ends is open.
+    """
+
+    def __init__(self):
+        self._ends = {}
+
+    def add(self, keys, points):
+        """Add a chain.
+        :returns: List -- [(points, closed), ...] of the lines completed by it
+        """
+        chain = [list(keys), list(points)]
+        while True:
+            if len(chain[0]) > 1 and chain[0][0] == chain[0][-1]:
+                return [(chain[1], True)]
+
+            for key in (chain[0][0], chain[0][-1]):
+                other = self._ends.get(key)
+                if other is not None:
+                    break
+            else:
+                self._ends[chain[0][0]] = chain
+                self._ends[chain[0][-1]] = chain
+                return []
+
+            del self._ends[other[0][0]]
+            self._ends.pop(other[0][-1], None)
+            chain = _join(chain, other, key)
+
+    def finish(self):
+        """The lines whose ends never met another chain.
+        :returns: List -- [(points, closed), ...]
+        """
+        seen = set()
+        lines = []
+        for chain in self._ends.values():
+            if id(chain) not in seen:
+                seen.add(id(chain))
+                lines.append((chain[1], False))
+        self._ends = {}
+        return lines
+
+
+def _join(chain, other, key):
+    """Join two chains at a shared end key.
+    """
+    keys, points = chain
+    other_keys, other_points = other
+    if keys[-1] != key:
+        keys, points = keys[::-1], points[::-1]
+    if other_keys[0] != key:
+        other_keys, other_points = other_keys[::-1], other_points[::-1]
+    return [keys + other_keys[1:], points + other_points[1:]]
+
+
+def area(points):
+    """Enclosed area in pixels of a closed line.
+    """
+    p = np.asarray(points, dtype=float)
+    return 0.5 * abs(np.dot(p[:-1, 0], p[1:, 1]) - np.dot(p[1:, 0], p[:-1, 1]))
+
+
+def smooth_line(points, closed, smooth):
+    """Cut the corners of a line, Chaikin style, by an amount scaled like
+    the smooth parameter of bfalg-ndwi.
+    :param points: (row, col) positions; a closed line repeats its first
+    :param smooth: from 0, the line unchanged, to SMOOTH_MAX
+    :returns: List -- smoothed (row, col) positions
+    """
+    cut = 0.25 * min(max(smooth, 0.0) / SMOOTH_MAX, 1.0)
+    if cut == 0 or len(points) < 3:
+        return list(points)
+
+    p = np.asarray(points, dtype=float)
+    if closed:
+        p = p[:-1]
+    for _ in range(SMOOTH_ROUNDS):
+        following = np.roll(p, -1, axis=0) if closed else p[1:]
+        current = p if closed else p[:-1]
+        cuts = np.empty((2 * len(current), 2))
+        cuts[0::2] = (1 - cut) * current + cut * following
+        cuts[1::2] = cut * current + (1 - cut) * following
+        p = cuts if closed else np.vstack((p[:1], cuts, p[-1:]))
+    if closed:
+        p = np.vstack((p, p[:1]))
+
+    return [tuple(point) for point in p]
+
+
+def _dataset(filename):
+    from osgeo import gdal
+
+    if filename not in _DATASETS:
+        _DATASETS[filename] = gdal.Open(filename)
+    return _DATASETS[filename]
+
+
+def _read(source, window):
+    filename, band = source
+    b = _dataset(filename).GetRasterBand(band)
+    return b.ReadAsArray(*window), b.GetNoDataValue()
+
+
+def _ndwi_window(job):
+    """Pool worker, NDWI and histogram of one window.
+    """
+    green_source, nir_source, window = job
+    green, nodata = _read(green_source, window)
+    nir, _ = _read(nir_source, window)
+    index, valid = ndwi_index(green, nir, 0 if nodata is None else nodata)
+    histogram = np.histogram(index[valid], bins=HIST_BINS, range=(-1, 1))[0]
+    return window, index, histogram
+
+
+def _close_datasets():
+    """Drop the datasets opened by _read, closing them.
+    """
+    _DATASETS.clear()
+
+
+def _contour_window(job):
+    """Pool worker, contour chains of one block.
+    """
+    filename, threshold, window, xsize, ysize = job
+    xoff, yoff, width, height = window
+    # One more row and column, so the cells on the seams are traced too.
+    read = (xoff, yoff, min(width + 1, xsize - xoff),
+            min(height + 1, ysize - yoff))
+    values, _ = _read((filename, 1), read)
+    return contour_block(values, threshold, yoff, xoff, height, width, xsize)
+
+
+def _imap(function, jobs, processes, ahead=None):
+    """Results of function over jobs, in job order.
+    At most ahead jobs (default: twice the pool size) are submitted but not
+    yet consumed, so results waiting on a slow consumer stay bounded.
+    """
+    if processes == 1:
+        for job in jobs:
+            yield function(job)
+        return
+
+    ahead = ahead or 2 * processes
+    # Workers start without the parent's datasets.
+    pool = multiprocessing.Pool(processes, _close_datasets)
+    try:
+        pending = deque()
+        for job in jobs:
+            pending.append(pool.apply_async(function, (job,)))
+            if len(pending) >= ahead:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+
+
+def process(files, bands, ndwi_file, geojson_file, minsize=100.0,
+            smooth=0.0, block=BLOCK, processes=None):
+    """NDWI raster and shoreline GeoJSON of a scene, block by block.
+    :param files: one file with both bands, or a green and a NIR file
+    :param bands: band numbers of the green and NIR bands
+    :param minsize: closed lines enclosing fewer pixels are dropped
+    :param smooth: corner smoothing, see smooth_line
+    :param block: window size in pixels
+    :param processes: pool size (default: every core this process may use)
+    :returns: Dict -- threshold, windows and features
+    """
+    try:
+        return _process(files, bands, ndwi_file, geojson_file, minsize,
+                        smooth, block, processes)
+    finally:
+        _close_datasets()
+
+
+def _process(files, bands, ndwi_file, geojson_file, minsize, smooth, block,
+             processes):
+    from osgeo import gdal, osr
+
+    from ndwi_tiles import available_cpus
+
+    green_source = (files[0], bands[0])
+    nir_source = (files[-1], bands[1])
+    source = gdal.Open(files[0])
+    xsize, ysize = source.RasterXSize, source.RasterYSize
+    transform = source.GetGeoTransform()
+    projection = source.GetProjection()
+    source = None
+
+    processes = processes or available_cpus()
+    blocks = windows(xsize, ysize, block)
+
+    out = gdal.GetDriverByName('GTiff').Create(
+        ndwi_file, xsize, ysize, 1, gdal.GDT_Float32,
+        ['TILED=YES', 'BLOCKXSIZE=%d' % TILE, 'BLOCKYSIZE=%d' % TILE,
+         'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER'])
+    out.SetGeoTransform(transform)
+    out.SetProjection(projection)
+    band = out.GetRasterBand(1)
+    band.SetNoDataValue(NODATA)
+
+    histogram = np.zeros(HIST_BINS, dtype=np.int64)
+    for window, index, counts in _imap(
+            _ndwi_window, [(green_source, nir_source, w) for w in blocks],
+            processes):
+        band.WriteArray(index, window[0], window[1])
+        histogram += counts
+    band = None
+    out = None
+
+    threshold = otsu(histogram)
+    print('NDWI threshold %.4f over %d windows' % (threshold, len(blocks)))
+
+    # Pixel centres to longitude and latitude, like bfalg-ndwi output.
+    source_srs = osr.SpatialReference(wkt=projection)
+    target_srs = osr.SpatialReference()
+    target_srs.ImportFromEPSG(4326)
+    for srs in (source_srs, target_srs):
+        if hasattr(srs, 'SetAxisMappingStrategy'):
+            srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    to_lonlat = osr.CoordinateTransformation(source_srs, target_srs)
+
+    def feature(points, closed):
+        if len(points) < 2 or (closed and area(points) < minsize):
+            return None
+        p = np.asarray(smooth_line(points, closed, smooth)) + 0.5
+        x = transform[0] + p[:, 1] * transform[1] + p[:, 0] * transform[2]
+        y = transform[3] + p[:, 1] * transform[4] + p[:, 0] * transform[5]
+        coordinates = [list(c[:2]) for c in
+                       to_lonlat.TransformPoints(list(zip(x, y)))]
+        return {'type': 'Feature', 'properties': {},
+                'geometry': {'type': 'LineString',
+                             'coordinates': coordinates}}
+
+    def features():
+        stitcher = Stitcher()
+        for chains in _imap(_contour_window,
+                            [(ndwi_file, threshold, w, xsize, ysize)
+                             for w in blocks], processes):
+            for keys, points in chains:
+                for line in stitcher.add(keys, points):
+                    f = feature(*line)
+                    if f is not None:
+                        yield f
+        for line in stitcher.finish():
+            f = feature(*line)
+            if f is not None:
+                yield f
+
+    with open(geojson_file, 'w') as f:
+        count = write_collection(f, features(), {
+            'crs': {'type': 'name', 'properties': {'name': 'EPSG:4326'}}})
+
+    return {'threshold': threshold, 'windows': len(blocks), 'features': count}
@@ -0,0 +1,231 @@
+"""Run bfalg-ndwi in-process over the tiles of a scene.
+
+Each tile is processed by the library's Python API in its own pool worker and
+written under its own basename, then the shorelines are merged into one
+GeoJSON and the NDWI rasters mosaicked into one GeoTIFF.  Wall time scales
+with the number of cores rather than the number of tiles.
+
+Scenes too large for bfalg-ndwi to hold in memory can use the block engine
+of ndwi_blocks instead, which processes each tile in fixed size windows.
+"""
+from __future__ import print_function
+
+import multiprocessing
+import os
+import time
+
+from geojson_stream import iter_features, write_collection
+from ndwi_blocks import NODATA, process as blocks
+
+# Pool size, by default every core the container may use.
+PROCESSES = os.environ.get('SHORELINE_NDWI_PROCESSES')
+
+# 'bfalg' for bfalg-ndwi, 'blocks' for the bounded memory block engine.
+ENGINE = os.environ.get('SHORELINE_NDWI_ENGINE', 'bfalg')
+ENGINES = ('bfalg', 'blocks')
+
+
+def available_cpus():
+    """Cores this process may run on, which respects container cpusets.
+    :returns: int
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return multiprocessing.cpu_count()
+
+
+def tile_jobs(tiles, bands, outdir, minsize, smooth):
+    """One job per tile, each with its own basename.
+    :param tiles: List -- [[filename, ...], ...], the input files of each tile
+    :param bands: band numbers of the green and NIR bands
+    :param outdir: directory for the per tile outputs
+    :returns: List -- [(tile basename, filenames, bands, outdir, minsize,
+        smooth), ...]
+    """
+    return [('bf_%04d' % i, list(files), list(bands), outdir,
+             float(minsize), float(smooth))
+            for (i, files) in enumerate(tiles)]
+
+
+def run_tile(job):
+    """Pool worker, runs NDWI and shoreline extraction for one tile.
+    bfalg_ndwi is imported here, so the merging below works without it.
+    :returns: basename, geojson file, ndwi file, seconds, error or None
+    """
+    from bfalg_ndwi.ndwi import open_image, process
+
+    bname, files, bands, outdir, minsize, smooth = job
+    start = time.time()
+    try:
+        geoimg = open_image(files, bands)
+        process(geoimg, outdir=outdir, bname=bname, minsize=minsize,
+                smooth=smooth)
+        geoimg = None
+        error = None
+    except Exception as e:
+        error = '%s: %s' % (type(e).__name__, e)
+
+    return (bname, os.path.join(outdir, bname + '.geojson'),
+            os.path.join(outdir, bname + '_ndwi.tif'),
+            time.time() - start, error)
+
+
+def run_blocks(job, processes=None):
+    """Runs NDWI and shoreline extraction for one tile with the block
+    engine, whose windows are spread over their own pool.
+    :returns: basename, geojson file, ndwi file, seconds, error or None
+    """
+    bname, files, bands, outdir, minsize, smooth = job
+    geojson_file = os.path.join(outdir, bname + '.geojson')
+    ndwi_file = os.path.join(outdir, bname + '_ndwi.tif')
+    start = time.time()
+    try:
+        blocks(files, bands, ndwi_file, geojson_file, minsize=minsize,
+               smooth=smooth, processes=processes)
+        error = None
+    except Exception as e:
+        error = '%s: %s' % (type(e).__name__, e)
+
+    return bname, geojson_file, ndwi_file, time.time() - start, error
+
+
+def run_tiles(jobs, processes=None):
+    """Process tiles over a pool, one task per tile.
+    :param processes: pool size (default: SHORELINE_NDWI_PROCESSES or
+        available_cpus)
+    :returns: List -- [(basename, geojson file, ndwi file, seconds, error),
+        ...] in job order
+    """
+    processes = int(processes or PROCESSES or available_cpus())
+    processes = max(1, min(processes, len(jobs)))
+
+    if processes == 1:
+        return [run_tile(job) for job in jobs]
+
+    # A fresh worker per tile, gippy does not release all of an image's
+    # memory when it is closed.
+    pool = multiprocessing.Pool(processes, maxtasksperchild=1)
+    try:
+        return pool.map(run_tile, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def merge_geojson(filenames, out_file):
+    """Concatenate the features of several FeatureCollections, streaming.
+    Members other than the features come from the first file.
+    :returns: number of features written
+    """
+    members = {}
+
+    def features():
+        for i, filename in enumerate(filenames):
+            with open(filename) as f:
+                for feature in iter_features(f, members if i == 0 else {}):
+                    yield feature
+
+    with open(out_file, 'w') as out:
+        return write_collection(out, features(), members)
+
+
+def mosaic(filenames, out_file, nodata=0):
+    """Mosaic GeoTIFFs into one, later tiles on top where they overlap.
+    :param nodata: value of the pixels a tile does not cover
+    """
+    if len(filenames) == 1:
+        os.rename(filenames[0], out_file)
+        return
+
+    from osgeo import gdal
+
+    vrt = out_file + '.vrt'
+    gdal.BuildVRT(vrt, filenames, srcNodata=nodata, VRTNodata=nodata)
+    gdal.Translate(out_file, vrt, format='GTiff',
+                   creationOptions=['TILED=YES', 'COMPRESS=DEFLATE',
+                                    'BIGTIFF=IF_SAFER'])
+    os.remove(vrt)
+    for filename in filenames:
+        os.remove(filename)
+
+
+def empty(tiles, vector_dir, raster_dir, engine=None):
+    """Outputs of a scene with no shoreline: an empty bf.geojson and a
+    bf_ndwi.tif of nodata covering the tiles, on the grid of the first.
+    No pixel is written, so the raster stays a few kilobytes.
+    :param tiles: List -- [[filename, ...], ...], the input files of each tile
+    :param engine: one of ENGINES (default: SHORELINE_NDWI_ENGINE or bfalg),
+        whose nodata value is used
+    """
+    from osgeo import gdal
+
+    with open(os.path.join(vector_dir, 'bf.geojson'), 'w') as f:
+        write_collection(f, [])
+
+    datasets = []
+    for files in tiles:
+        dataset = gdal.Open(files[0])
+        if dataset is None:
+            raise IOError('Cannot open %s' % files[0])
+        datasets.append(dataset)
+    t = datasets[0].GetGeoTransform()
+    left = min(d.GetGeoTransform()[0] for d in datasets)
+    top = max(d.GetGeoTransform()[3] for d in datasets)
+    right = max(d.GetGeoTransform()[0] + d.RasterXSize * t[1]
+                for d in datasets)
+    bottom = min(d.GetGeoTransform()[3] + d.RasterYSize * t[5]
+                 for d in datasets)
+
+    out = gdal.GetDriverByName('GTiff').Create(
+        os.path.join(raster_dir, 'bf_ndwi.tif'),
+        int(round((right - left) / t[1])), int(round((bottom - top) / t[5])),
+        1, gdal.GDT_Float32,
+        ['TILED=YES', 'COMPRESS=DEFLATE', 'SPARSE_OK=TRUE',
+         'BIGTIFF=IF_SAFER'])
+    out.SetGeoTransform((left, t[1], 0, top, 0, t[5]))
+    out.SetProjection(datasets[0].GetProjection())
+    out.GetRasterBand(1).SetNoDataValue(
+        NODATA if (engine or ENGINE) == 'blocks' else 0)
+    out = None
+
+
+def ndwi(tiles, bands, vector_dir, raster_dir, minsize, smooth,
+         processes=None, engine=None):
+    """Shorelines and NDWI of a scene.
+    Writes bf.geojson to vector_dir and bf_ndwi.tif to raster_dir.
+    :param tiles: List -- [[filename, ...], ...], the input files of each tile
+    :param bands: band numbers of the green and NIR bands
+    :param engine: one of ENGINES (default: SHORELINE_NDWI_ENGINE or bfalg)
+    :returns: List -- [{'tile', 'seconds', 'error'}, ...]
+    :raises RuntimeError: if no tile could be processed
+    """
+    engine = engine or ENGINE
+    if engine not in ENGINES:
+        raise ValueError('Unknown NDWI engine %r' % engine)
+    if not tiles:
+        raise RuntimeError('No tiles to process')
+
+    jobs = tile_jobs(tiles, bands, vector_dir, minsize, smooth)
+    if engine == 'blocks':
+        # One tile at a time, each over every core.
+        processes = int(processes or PROCESSES or available_cpus())
+        results = [run_blocks(job, processes) for job in jobs]
+    else:
+        results = run_tiles(jobs, processes)
+
+    done = [r for r in results if r[4] is None]
+    for bname, _, _, seconds, error in results:
+        print('%s: %.1fs%s' % (bname, seconds,
+                               ' failed, %s' % error if error else ''))
+
+    if not done:
+        raise RuntimeError('NDWI failed for all %d tiles' % len(results))
+
+    merge_geojson([r[1] for r in done], os.path.join(vector_dir, 'bf.geojson'))
+    mosaic([r[2] for r in done], os.path.join(raster_dir, 'bf_ndwi.tif'),
+           NODATA if engine == 'blocks' else 0)
+    for r in done:
+        os.remove(r[1])
+
+    return [{'tile': r[0], 'seconds': r[3], 'error': r[4]} for r in results]
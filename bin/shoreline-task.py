@@ -13,100 +13,194 @@
 from __future__ import print_function
 from gbdx_auth import gbdx_auth
 
-from cStringIO import StringIO
-from datetime import datetime
+import argparse
+from collections import defaultdict
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
 import dateutil.parser
 import glob2
-import math
 import os
+import re
 import requests
+import resource
 import sqlite3
-import geojson
+import sys
+import threading
+import time
 
-import dill
 import numpy as np
-from pytides.tide import Tide
 from shapely.geometry import shape
 from shapely.wkt import loads
 
-from gbdx_task_interface import GbdxTaskInterface
-
+try:
+    from urllib import pathname2url
+except ImportError:
+    from urllib.request import pathname2url
 
-def init_db(db_file, in_mem=False):
-    """Get DB ready by.
-    Can also load existing database into memory.
+from catalog import CatalogClient
+from coastal import PREFILTER, prefilter
+from gbdx_task_interface import GbdxTaskInterface
+from instrument import PROFILE_ENV, STAGES, profiled, stage
+from geojson_stream import METADATA_MODES, centroids, enrich
+from lru_cache import LRUCache
+from ndwi_tiles import empty, ndwi
+from station_index import StationIndex
+from tide_fit import fit_models
+import tide_export
+import tide_service
+from tide_store import TideStore
+from tide_table import TideTable, model_checksum
+
+
+def init_db(db_file, in_mem=False, mode=None, stats=None):
+    """Get DB ready.
+    Modes, cheapest in memory first:
+      disk      -- plain connection, pages read through the sqlite cache
+      readonly  -- query_only connection with mmap I/O and a large cache
+      immutable -- immutable=1 URI with mmap I/O, skipping all file locking;
+                   readonly on Python 2, which cannot open URIs
+      memory    -- whole database copied into :memory: with the backup API
+    :param db_file: sqlite file
+    :param in_mem: same as mode='memory', kept for existing callers
+    :param mode: one of DB_MODES (default: disk)
+    :param stats: optional Dict filled with the mode actually used,
+        load_seconds and peak_rss_kb, the growth in peak resident memory
+        while loading
     :returns: sqlite cursor
     """
-    conn = sqlite3.connect(db_file)
+    if mode is None:
+        mode = 'memory' if in_mem is True else 'disk'
+    if mode not in DB_MODES:
+        raise ValueError('Unknown database mode %s, expected one of %s.' %
+                         (mode, ', '.join(DB_MODES)))
 
-    if in_mem is True:
-        tempfile = StringIO()
-        for line in conn.iterdump():
-            tempfile.write('%s\n' % line)
-        conn.close()
+    start = time.time()
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
 
-        tempfile.seek(0)
-
-        conn = sqlite3.connect(":memory:")
-        conn.cursor().executescript(tempfile.read())
-        conn.commit()
+    if mode == 'memory':
+        conn = _copy_to_memory(db_file)
         conn.row_factory = sqlite3.Row
+    elif mode == 'immutable':
+        conn, mode = _connect_immutable(db_file)
+        _read_only_pragmas(conn)
+    elif mode == 'readonly':
+        conn = sqlite3.connect(db_file, check_same_thread=False)
+        _read_only_pragmas(conn)
+    else:
+        conn = sqlite3.connect(db_file, check_same_thread=False)
+
+    if stats is not None:
+        stats['mode'] = mode
+        stats['load_seconds'] = time.time() - start
+        stats['peak_rss_kb'] = (
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss)
+        print('Loaded %s in %s mode: %.3fs, peak RSS +%d kB' %
+              (db_file, mode, stats['load_seconds'], stats['peak_rss_kb']))
 
     return conn.cursor()
 
 
-def build_tide_model(data):
-    """Builds a model given tide data.
-    :param data: list of tuples [(date, height),...)]
-    :returns: Pytides model or None if data insufficient.
+def _copy_to_memory(db_file):
+    """Copy a database into :memory: without going through SQL text.
     """
+    conn = sqlite3.connect(':memory:', check_same_thread=False)
+
+    source = sqlite3.connect(db_file)
+    if hasattr(source, 'backup'):
+        source.backup(conn)
+        source.close()
+        return conn
+    source.close()
+
+    # Python 2 has no backup API, so copy table by table through an attached
+    # database, which keeps the rows inside sqlite.
+    conn.execute('attach database ? as source', (db_file,))
+    schema = conn.execute(
+        "select type, name, sql from source.sqlite_master "
+        "where sql is not null and name not like 'sqlite_%' "
+        "order by type in ('index', 'trigger'), rowid").fetchall()
+
+    # Shadow tables of virtual tables (e.g. an rtree) are filled by sqlite
+    # when the virtual table itself is copied.
+    virtual = [name for (kind, name, sql) in schema
+               if sql.upper().startswith('CREATE VIRTUAL TABLE')]
+    for kind, name, sql in schema:
+        if any(name.startswith(v + '_') for v in virtual):
+            continue
+        conn.execute(sql)
+        if kind == 'table':
+            conn.execute('insert into main."%s" select * from source."%s"' %
+                         (name, name))
+
+    conn.commit()
+    conn.execute('detach database source')
+    return conn
+
+
+def _connect_immutable(db_file):
+    """Open a database that will not change under us, without locking.
+    :returns: connection, mode actually used -- 'immutable' or 'readonly'
+    """
+    uri = 'file:%s?immutable=1' % pathname2url(os.path.abspath(db_file))
     try:
-        dates, heights = zip(*data)
-        dates = [datetime.strptime(date, '%Y-%m-%d-%H') for date in dates]
-        return Tide.decompose(heights, dates).model
-    except:
-        return None
+        return (sqlite3.connect(uri, uri=True, check_same_thread=False),
+                'immutable')
+    except TypeError:
+        # Python 2 cannot pass URIs, fall back to a plain read only
+        # connection.
+        print('immutable mode needs Python 3, using readonly')
+        return sqlite3.connect(db_file, check_same_thread=False), 'readonly'
+
+
+def _read_only_pragmas(conn):
+    """Tune a connection that is only ever read.
+    """
+    conn.execute('pragma query_only = 1')
+    conn.execute('pragma mmap_size = %d' % DB_MMAP_SIZE)
+    conn.execute('pragma cache_size = -%d' % DB_CACHE_KB)
+    conn.execute('pragma temp_store = memory')
 
 
 def build_tide_models(tide_model_file):
     """Build models for all stations.
-    :returns: Dict -- {'station_id': model, ...}
+    :param tide_model_file: tide_store directory
+    :returns: TideStore -- station_id -> Tide, built on access
     """
 
     # We try to read the pre fitted tidal models if they don't exists we create
-    # them this model for all the stations is very tiny, so run locally if the
-    # database of station data is updated to re-fit the model.
+    # them this model for all the stations is very tiny, so run tide_fit.py
+    # locally if the database of station data is updated to re-fit the model.
     try:
-        with open(tide_model_file, 'rb') as tm:
-            tide_models = dill.load(tm)
+        return TideStore(tide_model_file)
 
     except IOError:
-        tide_models = {}
-        for station in all_stations():
-            # station is like (1, )
-            station = station[0]
+        fit_models(DB_FILE, tide_model_file)
 
-            data = station_data(station)
-            model = build_tide_model(data)
+    return TideStore(tide_model_file)
 
-            if model is not None:
-                # see below, model is pickelable
-                # Tide is not.
-                tide_models[station] = model
 
-            else:
-                tide_models[station] = None
+def _prediction_time(dtg=None):
+    """Parse a date time group, defaulting to the current minute.
+    :param dtg: Date time group.
+    :type dtg: String -- "Y-m-d-H-M"
+    :returns: datetime
+    """
+    if dtg is None:
+        dtg = datetime.now()
+        dtg = datetime.strftime(dtg, '%Y-%m-%d-%H-%M')
 
-        # Store data for later
-        with open(tide_model_file, 'wb') as tm:
-            dill.dump(tide_models,
-                      tm,
-                      protocol=dill.HIGHEST_PROTOCOL)
+    t = datetime.strptime(dtg, '%Y-%m-%d-%H-%M')
 
-    # we are doing it like this because the instantiated Tide is apparently not
-    # pickelable even using dill, also we can't build a model if v is None.
-    return {k: Tide(model=v, radians=False) if v is not None else v
-            for (k, v) in tide_models.iteritems()}
+    # Round to the resolution predictions are cached at.
+    step = 60 * PREDICTION_RESOLUTION
+    seconds = (t - EPOCH).total_seconds()
+    return EPOCH + timedelta(seconds=round(seconds / step) * step)
+
+
+def _summarize(low, high, start):
+    """Minimum, maximum and current tide in meters from heights in mm.
+    """
+    return float(low) / 1000, float(high) / 1000, float(start) / 1000
 
 
 def predict_tides(station, dtg=None):
@@ -116,94 +210,112 @@ def predict_tides(station, dtg=None):
     :param dtg: Date time group.
     :type dtg: String -- "Y-m-d-H-M"
     """
-    if dtg is None:
-        dtg = datetime.now()
-        dtg = datetime.strftime(dtg, '%Y-%m-%d-%H-%M')
-        prediction_t0 = datetime.strptime(dtg,
-                                          '%Y-%m-%d-%H-%M')
-    else:
-        prediction_t0 = datetime.strptime(dtg,
-                                          '%Y-%m-%d-%H-%M')
+    prediction_t0 = _prediction_time(dtg)
 
-    hours = 0.1 * np.arange(1 * 24 * 10)
-    times = Tide._times(prediction_t0, hours)
+    summary = PREDICTION_CACHE.get((station, prediction_t0))
+    if summary is not None:
+        mint, maxt, ctide = summary
+        return mint, maxt, ctide, str(prediction_t0)
 
-    # Predict the tides using the Pytides model.
+    # The extremes of the window come from the tide table, or the exact high
+    # and low waters of the vectorized engine, which matches the Pytides
+    # model.
     try:
-        model = TIDE_MODEL[station]
-        my_prediction = model.at(times)
-        ctide = float(my_prediction[0]) / 1000
-        mint = float(min(my_prediction)) / 1000
-        maxt = float(max(my_prediction)) / 1000
+        lows, highs, starts = window_extremes([station], [prediction_t0])
+        mint, maxt, ctide = _summarize(lows[0], highs[0], starts[0])
+        PREDICTION_CACHE.put((station, prediction_t0), (mint, maxt, ctide))
     except:
         ctide = 'null'
         mint = 'null'
         maxt = 'null'
 
-    return mint, maxt, ctide, str(times[0])
+    return mint, maxt, ctide, str(prediction_t0)
 
 
-def nearest_station(lat, lon):
-    """Query our db for the nearest station.
-    Returns the station along with all the
-    data for the station.
-    :param lat: Latitude
-    :type lat: float
-    :param lon: Longitude
-    :type lon: float
-    :returns: Station id -- String
+def window_extremes(stations, t0s):
+    """Lowest, highest and starting heights in the PREDICTION_WINDOW after
+    each start time, looked up in the tide table where it covers the window
+    and predicted from the models otherwise.
+    :param stations: station id for each point
+    :param t0s: datetime for each point
+    :returns: lowest, highest and starting heights in mm -- arrays
     """
-    if lat is None or lon is None:
-        return '-9999'
+    table = get_tide_table()
+    in_table = np.array([table is not None and station in table and
+                         table.covers(t0, PREDICTION_WINDOW)
+                         for (station, t0) in zip(stations, t0s)], dtype=bool)
 
-    if lat > 90 or lat < -90 or lon < -180 or lon > 180:
-        return '-9999'
+    extremes = np.empty((3, len(stations)))
+    for mask, source in ((in_table, table), (~in_table, get_tide_engine())):
+        if mask.any():
+            points = np.flatnonzero(mask)
+            extremes[:, points] = source.extreme_points(
+                [stations[i] for i in points], [t0s[i] for i in points],
+                PREDICTION_WINDOW)
 
-    cur_cos_lat = math.cos(lat * math.pi / 180.0)
-    cur_sin_lat = math.sin(lat * math.pi / 180.0)
-    cur_cos_lon = math.cos(lon * math.pi / 180.0)
-    cur_sin_lon = math.sin(lon * math.pi / 180.0)
+    return extremes[0], extremes[1], extremes[2]
 
-    t = (
-        cur_sin_lat,
-        cur_cos_lat,
-        cur_cos_lon,
-        cur_sin_lon
-    )
 
-    command = (
-        """
-        select station, (%f * sin_lat + \
-        %f * cos_lat * \
-        (cos_lon * %f + sin_lon * %f)) dist \
-        from stations order by dist desc limit 1;""" % t)
-
-    DB_CURSOR.execute(command)
-    station, _ = DB_CURSOR.fetchone()
+def tide_extrema(station, dtg=None, hours=None):
+    """High and low waters at a station after a date.
+    :param station: The station id.
+    :param dtg: Date time group.
+    :type dtg: String -- "Y-m-d-H-M"
+    :param hours: length of the window (default: PREDICTION_WINDOW)
+    :returns: List -- [{'time': datetime, 'height': meters,
+        'type': 'high' or 'low'}, ...] in time order
+    """
+    prediction_t0 = _prediction_time(dtg)
+    times, heights, highs = get_tide_engine().extrema(
+        station, prediction_t0, hours or PREDICTION_WINDOW)
 
-    return station
+    return [{'time': prediction_t0 + timedelta(hours=float(t)),
+             'height': float(h) / 1000,
+             'type': 'high' if high else 'low'}
+            for (t, h, high) in zip(times, heights, highs)]
 
 
-def station_data(station_id):
-    """Get the historical tide data for a station
-    :param station_id: The station id of interest
-    :type station_id: String
-    :returns: List of date, height tuples -- [(date, height),...]
+def cache_stats():
+    """Counters of the prediction cache. Models need no cache, the engine
+    reads every station's coefficients straight from the memory map.
+    :returns: Dict -- {'predictions': {...}}
     """
-    DB_CURSOR.execute('select date,mm from fdh where station=? order by date',
-                      (str(station_id),))
-
-    return DB_CURSOR.fetchall()
+    return {
+        'predictions': PREDICTION_CACHE.stats()
+    }
 
 
-def all_stations():
-    """ Get all the stations from the DB
-    Used for pre-building models predictive models
-    for each station.
+def nearest_station(lat, lon, max_distance=None):
+    """Look up the nearest station in the station index.
+    :param lat: Latitude
+    :type lat: float
+    :param lon: Longitude
+    :type lon: float
+    :param max_distance: Search radius in km (default: MAX_STATION_DISTANCE)
+    :type max_distance: float
+    :returns: Station id, '-9999' if none is in range -- String
+    """
+    return nearest_stations([lat], [lon], max_distance)[0]
+
+
+def nearest_stations(lats, lons, max_distance=None):
+    """Look up the nearest station to each of many points.
+    :param lats: Latitudes
+    :type lats: list of float
+    :param lons: Longitudes
+    :type lons: list of float
+    :param max_distance: Search radius in km (default: MAX_STATION_DISTANCE)
+    :type max_distance: float
+    :returns: Station ids, '-9999' for invalid points or none in range -- list
     """
-    command = 'select station from stations;'
-    DB_CURSOR.execute(command)
-    return DB_CURSOR.fetchall()
+    if max_distance is None:
+        max_distance = MAX_STATION_DISTANCE
+
+    station_index = get_station_index()
+    index, _ = station_index.query(lats, lons, max_distance=max_distance)
+
+    return [station_index.stations[i] if i < len(station_index) else '-9999'
+            for i in index[:, 0]]
 
 
 def tide_coordination(lat, lon, dtg=None):
@@ -234,14 +346,202 @@ def tide_coordination(lat, lon, dtg=None):
     return out
 
 
-# Initialize the db, change in_mem=True for production if enough memory exists
-# for each worker to load the database (~250MB)
-db_file = '/opt/data/fdh.sqlite'
-DB_CURSOR = init_db(db_file, in_mem=False)
+def tide_coordination_batch(lats, lons, dtgs=None):
+    """Tide data for many points at once.
+    Nearest stations are resolved together, points sharing a station and
+    prediction time are predicted once, and all of those predictions run in
+    one vectorized pass.
+    :param lats: the latitudes
+    :type lats: list of float
+    :param lons: the longitudes
+    :type lons: list of float
+    :param dtgs: date time group for each point (default: now)
+    :type dtgs: list of String -- "Y-m-d-H-M"
+    :returns: the tide data for each point, in input order -- list of json
+    """
+    if dtgs is None:
+        dtgs = [None] * len(lats)
+
+    stations = nearest_stations(lats, lons)
+
+    out = [{
+        'minimumTide24Hours': 'null',
+        'maximumTide24Hours': 'null',
+        'currentTide': 'null'
+    } for _ in stations]
+
+    # Points whose station has no model keep the null result, points already
+    # in the prediction cache are served from it.
+    tide_engine = get_tide_engine()
+    times = {}
+    groups = defaultdict(list)
+    for i, station in enumerate(stations):
+        if station not in tide_engine:
+            continue
+        dtg = dtgs[i]
+        if dtg not in times:
+            times[dtg] = _prediction_time(dtg)
+        groups[(station, times[dtg])].append(i)
+
+    summaries = {}
+    misses = []
+    for key in groups:
+        summaries[key] = PREDICTION_CACHE.get(key)
+        if summaries[key] is None:
+            misses.append(key)
+
+    if misses:
+        extremes = window_extremes([station for (station, _) in misses],
+                                   [t0 for (_, t0) in misses])
+
+        for key, heights in zip(misses, zip(*extremes)):
+            summaries[key] = _summarize(*heights)
+            PREDICTION_CACHE.put(key, summaries[key])
+
+    for key, points in groups.items():
+        mint, maxt, ctide = summaries[key]
+        for i in points:
+            out[i]['minimumTide24Hours'] = mint
+            out[i]['maximumTide24Hours'] = maxt
+            out[i]['currentTide'] = ctide
+
+    return out
+
+
+# Points further than this from every station (km) get no tide data.
+MAX_STATION_DISTANCE = float(os.environ.get('SHORELINE_MAX_STATION_KM', 'inf'))
+
+# Hours after the scene over which the minimum and maximum tide are taken.
+PREDICTION_WINDOW = 24.0
+
+# Prediction times are rounded to this many minutes, so nearby scenes at a
+# station share a cache entry.
+PREDICTION_RESOLUTION = float(
+    os.environ.get('SHORELINE_PREDICTION_RESOLUTION', '1'))
+EPOCH = datetime(1970, 1, 1)
+
+# Bounded cache of (station, time) prediction summaries.
+PREDICTION_CACHE = LRUCache(
+    int(os.environ.get('SHORELINE_PREDICTION_CACHE_SIZE', '4096')))
+
+# Where shoreline tides are predicted:
+#   scene    at the centroid of the catalog footprint, the same for every
+#            feature
+#   feature  at the centroid of each feature, from its nearest station
+TIDE_MODES = ('scene', 'feature')
+
+# Scenes processed at once in batch mode.
+SCENE_WORKERS = int(os.environ.get('SHORELINE_SCENE_WORKERS', '2'))
+
+# Catalog ids name the output directories of a batch.
+CAT_ID_PATTERN = re.compile(r'^[0-9A-Za-z_-]+$')
+
+# The GDAL stages of a scene, prefilter and NDWI, run one scene at a time:
+# NDWI forks a process pool, and a fork while another thread holds a lock
+# inside GDAL or multiprocessing can leave the child waiting on it forever.
+_NDWI_LOCK = threading.Lock()
+
+# Database load strategy, see init_db. memory copies the whole database
+# (~250MB) into each worker; readonly and immutable share the page cache.
+DB_FILE = '/opt/data/fdh.sqlite'
+DB_MODES = ('disk', 'readonly', 'immutable', 'memory')
+DB_MODE = os.environ.get('SHORELINE_DB_MODE', 'disk')
+DB_MMAP_SIZE = 1 << 30
+DB_CACHE_KB = 64 * 1024
+TIDE_MODEL_FILE = '/opt/data/tidemodel'
+
+# Precomputed heights, see tide_table; used where present and built from the
+# current tide models.
+TIDE_TABLE_FILE = os.environ.get('SHORELINE_TIDE_TABLE', '/opt/data/tidetable')
+
+# Shared state is built on first use, so runs that never look up a tide never
+# open the database or the tide models.
+_INIT_LOCK = threading.RLock()
+_DB_CURSOR = None
+_STATION_INDEX = None
+_TIDE_MODEL = None
+_TIDE_ENGINE = None
+# None until looked for, False if there is no usable table.
+_TIDE_TABLE = None
+
+
+def get_db_cursor():
+    """Initialize the db on first use.
+    :returns: sqlite cursor
+    """
+    global _DB_CURSOR
+    with _INIT_LOCK:
+        if _DB_CURSOR is None:
+            with stage('init_db'):
+                _DB_CURSOR = init_db(DB_FILE, mode=DB_MODE, stats={})
+    return _DB_CURSOR
+
 
-# build the tide model
-tide_model = '/opt/data/tidemodel.pkl'
-TIDE_MODEL = build_tide_models(tide_model)
+def get_station_index():
+    """Load the station index on first use.
+    :returns: StationIndex
+    """
+    global _STATION_INDEX
+    with _INIT_LOCK:
+        if _STATION_INDEX is None:
+            cursor = get_db_cursor()
+            with stage('station_index'):
+                _STATION_INDEX = StationIndex.from_cursor(cursor)
+    return _STATION_INDEX
+
+
+def get_tide_model():
+    """Open the tide models on first use. Nothing is read for a station
+    until it is queried.
+    :returns: TideStore
+    """
+    global _TIDE_MODEL
+    with _INIT_LOCK:
+        if _TIDE_MODEL is None:
+            with stage('tide_models'):
+                _TIDE_MODEL = build_tide_models(TIDE_MODEL_FILE)
+    return _TIDE_MODEL
+
+
+def get_tide_engine():
+    """Prediction engine over the memory mapped tide models.
+    :returns: TideEngine
+    """
+    global _TIDE_ENGINE
+    with _INIT_LOCK:
+        if _TIDE_ENGINE is None:
+            model = get_tide_model()
+            with stage('tide_engine'):
+                _TIDE_ENGINE = model.engine()
+    return _TIDE_ENGINE
+
+
+def get_tide_table():
+    """Open the tide table on first use.
+    :returns: TideTable, None without a table matching the tide models
+    """
+    global _TIDE_TABLE
+    with _INIT_LOCK:
+        if _TIDE_TABLE is None:
+            engine = get_tide_engine()
+            with stage('tide_table'):
+                _TIDE_TABLE = False
+                if os.path.exists(TIDE_TABLE_FILE):
+                    table = TideTable(TIDE_TABLE_FILE)
+                    if table.checksum == model_checksum(engine):
+                        _TIDE_TABLE = table
+                    else:
+                        print('Ignoring %s, built from other tide models' %
+                              TIDE_TABLE_FILE)
+    return _TIDE_TABLE or None
+
+
+def warm_up():
+    """Load the station index and the tide models ahead of the first lookup.
+    """
+    get_station_index()
+    get_tide_engine()
+    get_tide_table()
 
 
 class ShorelineTask(GbdxTaskInterface):
@@ -255,76 +555,283 @@ class ShorelineTask(GbdxTaskInterface):
 
         # Get inputs
         cat_id = self.get_input_string_port('cat_id')
+        cat_ids = self.get_input_string_port('cat_ids')
         minsize = self.get_input_string_port('minsize', default='1000.0')
         smooth = self.get_input_string_port('smooth', default='1.0')
+        metadata_mode = self.get_input_string_port('metadata', default='full')
+        tide_mode = self.get_input_string_port('tides', default='scene')
+        if metadata_mode not in METADATA_MODES:
+            raise ValueError('Unknown metadata mode %s, expected one of %s' %
+                             (metadata_mode, ', '.join(METADATA_MODES)))
+        if tide_mode not in TIDE_MODES:
+            raise ValueError('Unknown tides mode %s, expected one of %s' %
+                             (tide_mode, ', '.join(TIDE_MODES)))
+
+        if cat_ids:
+            self.invoke_batch(cat_ids.replace(',', ' ').split(), minsize,
+                              smooth, metadata_mode, tide_mode)
+            return
+
         img = self.get_input_data_port('image')
 
-        url = 'https://geobigdata.io/catalog/v2/record/%s' % cat_id
-        r = self.gbdx_connection.get(url)
-        r.raise_for_status()
-        record = r.json()
-        centroid = loads(record.get('properties').get('footprintWkt')).centroid
+        # The tide models load while the catalog record is fetched.
+        background = ThreadPool(1)
+        try:
+            warm = background.apply_async(warm_up)
+            tiles = self.process_scene(
+                CatalogClient(self.gbdx_connection), cat_id, img,
+                self.get_output_data_port('vector'),
+                self.get_output_data_port('raster'), minsize, smooth,
+                metadata_mode, tide_mode)
+            warm.get()
+        finally:
+            background.close()
+            background.join()
+
+        self.set_status_info('tiles', tiles)
+        self.reason = 'Successfully created shoreline GeoJSON'
+
+    def finalize(self, success_or_fail, message=''):
+        # Timings of every stage of the run, see instrument.
+        self.set_status_info('stages', STAGES.report())
+        super(ShorelineTask, self).finalize(success_or_fail, message)
+
+    def invoke_batch(self, cat_ids, minsize, smooth, metadata_mode,
+                     tide_mode='scene'):
+        """Process many scenes in one container.
+        The images come from the multiplexed image ports, matched to cat_ids
+        in port name order. Each scene writes to vector/<cat_id> and
+        raster/<cat_id>, and its outcome is listed under scenes in
+        status.json; the batch only fails if every scene does.
+        """
+        invalid = [cat_id for cat_id in cat_ids
+                   if not CAT_ID_PATTERN.match(cat_id)]
+        if invalid:
+            raise ValueError('Invalid catalog ids: %s' % ', '.join(invalid))
+
+        images = sorted(self.get_multiplex_input_data_port('image'),
+                        key=_port_order)
+        if len(images) != len(cat_ids):
+            raise ValueError('Got %d catalog ids for %d image ports.' %
+                             (len(cat_ids), len(images)))
+
+        # Shared state is loaded once, before any scene starts.
+        warm_up()
+        client = CatalogClient(self.gbdx_connection)
+
+        # Scenes run on threads, overlapping catalog lookups, tides and
+        # enrichment; NDWI takes every core, one scene at a time.
+        workers = max(1, min(SCENE_WORKERS, len(cat_ids)))
+
+        def run(scene):
+            cat_id, img = scene
+            start = time.time()
+            tiles = None
+            try:
+                tiles = self.process_scene(
+                    client, cat_id, img,
+                    os.path.join(self.get_output_data_port('vector'), cat_id),
+                    os.path.join(self.get_output_data_port('raster'), cat_id),
+                    minsize, smooth, metadata_mode, tide_mode)
+                status, reason = 'success', None
+            except Exception as e:
+                status, reason = 'failed', '%s: %s' % (type(e).__name__, e)
+            print('Scene %s: %s%s' % (cat_id, status,
+                                     ', %s' % reason if reason else ''))
+            return {'cat_id': cat_id, 'image': os.path.basename(img),
+                    'status': status, 'reason': reason, 'tiles': tiles,
+                    'seconds': time.time() - start}
+
+        pool = ThreadPool(workers)
+        try:
+            scenes = pool.map(run, list(zip(cat_ids, images)), chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        done = sum(1 for scene in scenes if scene['status'] == 'success')
+        self.set_status_info('scenes', scenes)
+        self.reason = 'Created shoreline GeoJSON for %d of %d scenes' % (
+            done, len(scenes))
+        if not done:
+            self.status = 'failed'
+
+    def process_scene(self, client, cat_id, img, vector_dir, raster_dir,
+                      minsize, smooth, metadata_mode, tide_mode='scene',
+                      processes=None):
+        """Tides, NDWI and shorelines of one scene.
+        The tides are predicted while NDWI runs and joined before enrichment.
+        :param client: CatalogClient
+        :param tide_mode: one of TIDE_MODES
+        :param processes: NDWI pool size (default: every core)
+        :returns: Dict -- {'tiles': number of tiles, 'skipped': [{'tile',
+            'reason'}, ...] tiles the prefilter left out}
+        """
+        with stage('catalog', scene=cat_id):
+            record = client.record(cat_id)
+        footprint = loads(record.get('properties').get('footprintWkt'))
+        centroid = footprint.centroid
         lat = centroid.y
         lon = centroid.x
         timestamp = dateutil.parser.parse(
             record.get('properties').get('timestamp'))
         dtg = datetime.strftime(timestamp, '%Y-%m-%d-%H-%M')
 
-        vector_dir = self.get_output_data_port('vector')
-        os.makedirs(vector_dir)
-
-        raster_dir = self.get_output_data_port('raster')
-        os.makedirs(raster_dir)
-
-        tide = tide_coordination(float(lat), float(lon), dtg)
-
-        result = {
-            'metadata': record,
-            'tides': tide
-        }
-
-        platform = record.get('properties').get('platformName')
-        print("Platform detected as", platform)
-        if platform in ('WORLDVIEW02', 'WORLDVIEW03'):
-            all_lower = glob2.glob('%s/**/*.tif' % img)
-            all_upper = glob2.glob('%s/**/*.TIF' % img)
-            all_files = all_lower + all_upper
-
-            for img_file in all_files:
-                os.system('bfalg-ndwi -i %s -b 1 8 --outdir %s --basename bf --minsize %s --smooth %s' %
-                          (img_file, vector_dir, minsize, smooth))
-        elif platform == 'LANDSAT08':
-            img1 = glob2.glob('%s/**/*_B1.TIF' % img)
-            img2 = glob2.glob('%s/**/*_B5.TIF' % img)
-
-            os.system('bfalg-ndwi -i %s -i %s --outdir %s --basename bf --minsize %s --smooth %s' %
-                      (img1[0], img2[0], vector_dir, minsize, smooth))
-
-        os.rename(os.path.join(vector_dir, 'bf_ndwi.tif'),
-                  os.path.join(raster_dir, 'bf_ndwi.tif'))
-
-        # Okay, so we need to open the output bf.geojson here, and iterate
-        # through the features, added result to properties for each and every
-        # one.
-
-        with open(os.path.join(vector_dir, 'bf.geojson')) as f:
-            data = geojson.load(f)
-
-        feature_collection = data['features']
-        valid_feats = []
-
-        for feat in feature_collection:
-            feat['properties'] = result
-            valid_feats.append(feat)
-
-        data['features'] = valid_feats
+        def predict():
+            with stage('tide_coordination', scene=cat_id):
+                return tide_coordination(float(lat), float(lon), dtg)
+
+        background = ThreadPool(1)
+        try:
+            tides = background.apply_async(predict)
+
+            os.makedirs(vector_dir)
+            os.makedirs(raster_dir)
+
+            platform = record.get('properties').get('platformName')
+            print("Platform detected as", platform)
+            tiles = []
+            bands = None
+            if platform in ('WORLDVIEW02', 'WORLDVIEW03'):
+                all_lower = glob2.glob('%s/**/*.tif' % img)
+                all_upper = glob2.glob('%s/**/*.TIF' % img)
+                # glob2 matches without regard to case on some platforms, so
+                # a tile may be listed twice.
+                all_files = sorted(set(all_lower + all_upper))
+
+                # Every tile of the order, green and NIR are bands 1 and 8.
+                tiles = [[img_file] for img_file in all_files]
+                bands = [1, 8]
+            elif platform == 'LANDSAT08':
+                img1 = glob2.glob('%s/**/*_B1.TIF' % img)
+                img2 = glob2.glob('%s/**/*_B5.TIF' % img)
+
+                tiles = [[img1[0], img2[0]]]
+                bands = [1, 1]
+
+            # Tiles without valid pixels, or optionally without both water
+            # and land or a station nearby, are left out.
+            count = len(tiles)
+            kept = tiles
+            skipped = []
+            station_index = get_station_index() if PREFILTER else None
+            with _NDWI_LOCK:
+                if PREFILTER and tiles:
+                    with stage('prefilter', scene=cat_id, tiles=count):
+                        kept, skipped = prefilter(tiles, bands, station_index,
+                                                  footprint)
+                    for tile in skipped:
+                        print('Skipped %s, %s' % (tile['tile'],
+                                                  tile['reason']))
+
+                # Tiles run in parallel, merged into bf.geojson and
+                # bf_ndwi.tif. A scene whose every tile was skipped gets an
+                # empty bf.geojson and a nodata bf_ndwi.tif.
+                if kept or not skipped:
+                    with stage('ndwi', scene=cat_id, tiles=len(kept)):
+                        ndwi(kept, bands, vector_dir, raster_dir, minsize,
+                             smooth, processes)
+                else:
+                    empty(tiles, vector_dir, raster_dir)
+
+            tide = tides.get()
+        finally:
+            background.close()
+            background.join()
+
+        # Attach the record and tides to the shorelines, streaming the
+        # features so only one is in memory at a time.
+        shorelines = os.path.join(vector_dir, 'bf.geojson')
+        feature_tides = None
+        if tide_mode == 'feature':
+            # One batch for all features, each station and time predicted
+            # once however many features share it.
+            with stage('feature_tides', scene=cat_id):
+                lats, lons = centroids(shorelines)
+                feature_tides = tide_coordination_batch(lats, lons,
+                                                        [dtg] * len(lats))
+        with stage('enrich', scene=cat_id):
+            enrich(shorelines, shorelines + '.tmp', record, tide,
+                   metadata_mode, feature_tides)
+        os.rename(shorelines + '.tmp', shorelines)
+
+        return {'tiles': count, 'skipped': skipped}
+
+
+def _port_order(path):
+    """Sort key of multiplexed ports, image_2 before image_10.
+    """
+    name = os.path.basename(path)
+    return [int(part) if part.isdigit() else part
+            for part in re.split(r'(\d+)', name)]
 
-        with open(os.path.join(vector_dir, 'bf.geojson'), 'wb') as f:
-            geojson.dump(data, f)
 
-        self.reason = 'Successfully created shoreline GeoJSON'
+def serve_tides(argv):
+    """Run the tide service, see tide_service.
+    """
+    parser = argparse.ArgumentParser(prog='shoreline-task.py serve',
+                                     description='Serve tide predictions.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-batch', type=int, default=tide_service.MAX_BATCH,
+                        help='most queries predicted together')
+    parser.add_argument('--max-wait', type=float,
+                        default=1000 * tide_service.MAX_WAIT,
+                        help='milliseconds a query waits for a batch')
+    args = parser.parse_args(argv)
+
+    # Load everything before the first query arrives.
+    warm_up()
+    tide_service.serve(tide_coordination_batch, args.host, args.port,
+                       cache_stats, args.max_batch, args.max_wait / 1000)
+
+
+def export_tides(argv):
+    """Write a tide time series for a station or point, see tide_export.
+    """
+    parser = argparse.ArgumentParser(prog='shoreline-task.py export',
+                                     description='Export a tide time series.')
+    where = parser.add_mutually_exclusive_group(required=True)
+    where.add_argument('--station', help='station id')
+    where.add_argument('--point', nargs=2, type=float, metavar=('LAT', 'LON'),
+                       help='use the station nearest to this point')
+    parser.add_argument('--start', required=True, help='Y-m-d-H-M')
+    parser.add_argument('--end', required=True, help='Y-m-d-H-M')
+    parser.add_argument('--step', type=float, default=6.0,
+                        help='minutes between samples')
+    parser.add_argument('--format', choices=tide_export.FORMATS,
+                        help='default: npy for a .npy file, otherwise csv')
+    parser.add_argument('--out', required=True, help='output file')
+    args = parser.parse_args(argv)
+
+    engine = get_tide_engine()
+    station = args.station
+    if station is None:
+        station = nearest_station(*args.point)
+    elif station not in engine and station.isdigit():
+        # Station ids are integers in the database.
+        station = int(station)
+    if station not in engine:
+        raise SystemExit('No tide model for station %s' % station)
+
+    start = datetime.strptime(args.start, '%Y-%m-%d-%H-%M')
+    hours = (datetime.strptime(args.end, '%Y-%m-%d-%H-%M') -
+             start).total_seconds() / 3600
+    try:
+        count = tide_export.export(engine, station, start, hours,
+                                   args.step / 60, args.out, args.format)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    print('Wrote %d predictions for station %s to %s' % (count, station,
+                                                         args.out))
 
 
 if __name__ == "__main__":
-    with ShorelineTask() as task:
-        task.invoke()
+    if sys.argv[1:2] == ['serve']:
+        serve_tides(sys.argv[2:])
+    elif sys.argv[1:2] == ['export']:
+        export_tides(sys.argv[2:])
+    else:
+        with ShorelineTask() as task:
+            with profiled(os.environ.get(PROFILE_ENV)):
+                task.invoke()
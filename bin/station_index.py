@@ -0,0 +1,126 @@
+"""In-memory spatial index of tide stations.
+
+Stations are held as unit vectors on the sphere in a KD-tree, so the nearest
+station by great circle distance is the nearest by chord length.  Loaded once,
+lookups no longer touch the database.
+"""
+import sqlite3
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Mean Earth radius in kilometers.
+EARTH_RADIUS = 6371.0088
+
+
+def to_xyz(lats, lons):
+    """Unit vectors for arrays of latitudes and longitudes in degrees.
+    :returns: (points x 3) array
+    """
+    lat = np.radians(np.asarray(lats, dtype=float))
+    lon = np.radians(np.asarray(lons, dtype=float))
+
+    return np.column_stack((np.cos(lat) * np.cos(lon),
+                            np.cos(lat) * np.sin(lon),
+                            np.sin(lat)))
+
+
+class StationIndex(object):
+    """Nearest station lookups over a fixed set of stations.
+    """
+
+    def __init__(self, stations, xyz):
+        """
+        :param stations: station ids
+        :param xyz: (stations x 3) unit vectors, see to_xyz
+        """
+        self.stations = list(stations)
+        self.xyz = np.asarray(xyz, dtype=float)
+        self._tree = cKDTree(self.xyz)
+
+    @classmethod
+    def from_coordinates(cls, stations, lats, lons):
+        """
+        :param stations: station ids
+        :param lats: station latitudes in degrees
+        :param lons: station longitudes in degrees
+        :returns: StationIndex
+        """
+        return cls(stations, to_xyz(lats, lons))
+
+    @classmethod
+    def from_cursor(cls, cursor):
+        """Load every station from the stations table, using the unit vectors
+        to_db_station precomputes when the table has them.
+        :param cursor: sqlite cursor
+        :returns: StationIndex
+        """
+        try:
+            cursor.execute('select station, x, y, z from stations;')
+            rows = cursor.fetchall()
+            return cls([row[0] for row in rows],
+                       np.array([(row[1], row[2], row[3]) for row in rows],
+                                dtype=float).reshape(-1, 3))
+        except sqlite3.OperationalError:
+            pass
+
+        cursor.execute('select station, lat, lon from stations;')
+        rows = cursor.fetchall()
+
+        return cls.from_coordinates([row[0] for row in rows],
+                                    [row[1] for row in rows],
+                                    [row[2] for row in rows])
+
+    def __len__(self):
+        return len(self.stations)
+
+    def query(self, lats, lons, k=1, max_distance=None):
+        """Nearest stations to many points.
+        Invalid points and neighbours beyond max_distance come back as index
+        len(self) with an infinite distance.
+        :param lats: latitudes in degrees
+        :param lons: longitudes in degrees
+        :param k: number of neighbours
+        :param max_distance: great circle search radius in km (default: none)
+        :returns: indices, distances in km -- (points x k) arrays
+        """
+        lat = np.array(lats, dtype=float, ndmin=1)
+        lon = np.array(lons, dtype=float, ndmin=1)
+        k = min(k, len(self.stations))
+
+        valid = ~(np.isnan(lat) | np.isnan(lon))
+        valid[valid] = ((lat[valid] <= 90) & (lat[valid] >= -90) &
+                        (lon[valid] >= -180) & (lon[valid] <= 180))
+
+        index = np.full((len(lat), k), len(self.stations), dtype=int)
+        distance = np.full((len(lat), k), np.inf)
+        if not valid.any() or k == 0:
+            return index, distance
+
+        bound = np.inf
+        if max_distance is not None:
+            # Chord length of the search radius, widened a hair so a station
+            # exactly at max_distance is still found.
+            angle = min(max_distance / EARTH_RADIUS, np.pi)
+            bound = 2 * np.sin(angle / 2) * (1 + 1e-12)
+
+        chord, found = self._tree.query(to_xyz(lat[valid], lon[valid]), k=k,
+                                        distance_upper_bound=bound)
+        index[valid] = np.reshape(found, (-1, k))
+        distance[valid] = (2 * np.arcsin(np.clip(np.reshape(chord, (-1, k)) / 2,
+                                                 0, 1)) * EARTH_RADIUS)
+
+        return index, distance
+
+    def nearest(self, lat, lon, k=1, max_distance=None):
+        """Nearest stations to a point.
+        :param lat: Latitude
+        :param lon: Longitude
+        :param k: number of neighbours
+        :param max_distance: great circle search radius in km (default: none)
+        :returns: List -- [(station_id, distance_km), ...], nearest first
+        """
+        index, distance = self.query([lat], [lon], k, max_distance)
+
+        return [(self.stations[i], d) for (i, d) in zip(index[0], distance[0])
+                if i < len(self.stations)]
@@ -0,0 +1,82 @@
+import json
+import threading
+
+import pytest
+import requests
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from catalog import CatalogClient
+
+
+class _Catalog(BaseHTTPRequestHandler):
+    # Responses to send before the record, e.g. [503, 503].
+    failures = []
+    paths = []
+
+    def do_GET(self):
+        self.paths.append(self.path)
+        status = self.failures.pop(0) if self.failures else 200
+        if self.path.endswith('/missing'):
+            status = 404
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        if status == 200:
+            cat_id = self.path.rsplit('/', 1)[1]
+            self.wfile.write(json.dumps(
+                {'identifier': cat_id,
+                 'properties': {'platformName': 'WORLDVIEW02'}}).encode('utf-8'))
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    _Catalog.failures[:] = []
+    _Catalog.paths[:] = []
+    httpd = HTTPServer(('127.0.0.1', 0), _Catalog)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:%d/record/%%s' % httpd.server_address[1]
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_retries_then_caches(server, tmpdir):
+    _Catalog.failures[:] = [503, 500]
+    client = CatalogClient(url=server, cache_dir=str(tmpdir), backoff=0.01)
+
+    record = client.record('1030010')
+
+    assert record['identifier'] == '1030010'
+    assert len(_Catalog.paths) == 3
+    assert tmpdir.join('1030010.json').check()
+
+    again = CatalogClient(url=server, cache_dir=str(tmpdir)).record('1030010')
+    assert again == record
+    assert len(_Catalog.paths) == 3
+
+
+def test_gives_up(server):
+    _Catalog.failures[:] = [503] * 5
+    client = CatalogClient(url=server, cache_dir=None, retries=2, backoff=0.01)
+
+    with pytest.raises(requests.HTTPError):
+        client.record('1030010')
+    assert len(_Catalog.paths) == 3
+
+
+def test_no_retry_on_client_error(server, tmpdir):
+    client = CatalogClient(url=server, cache_dir=str(tmpdir), backoff=0.01)
+
+    with pytest.raises(requests.HTTPError):
+        client.record('missing')
+    assert len(_Catalog.paths) == 1
+    assert tmpdir.listdir() == []
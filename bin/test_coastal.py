@@ -0,0 +1,77 @@
+import numpy as np
+from shapely.geometry import box
+
+import coastal
+from coastal import near_station, prefilter, water_fraction
+from station_index import StationIndex
+
+# Honolulu and Boston harbours.
+INDEX = StationIndex.from_coordinates(['1612340', '8443970'],
+                                      [21.3067, 42.3539], [-157.867, -71.0503])
+
+
+def test_near_station():
+    assert near_station(box(-158.0, 21.2, -157.8, 21.4), INDEX, 10)
+    # The station is 30 km from the tile's centre but inside its bounds.
+    assert near_station(box(-158.2, 21.0, -157.5, 21.6), INDEX, 1)
+    assert not near_station(box(-100.1, 40.0, -100.0, 40.1), INDEX, 100)
+
+
+def test_water_fraction():
+    green = np.array([[30, 10, 10, 0]], dtype=np.uint16)
+    nir = np.array([[10, 30, 30, 5]], dtype=np.uint16)
+
+    assert water_fraction(green, nir) == 1 / 3.0
+    assert water_fraction(green[:, 3:], nir[:, 3:]) is None
+
+
+def test_prefilter_reasons(monkeypatch):
+    bands = {'coast.tif': (np.array([[30, 10]]), np.array([[10, 30]]), 0),
+             'land.tif': (np.array([[10, 10]]), np.array([[30, 30]]), 0),
+             'empty.tif': (np.array([[0]]), np.array([[0]]), 0)}
+    monkeypatch.setattr(coastal, 'raster_footprint',
+                        lambda f: box(-158.0, 21.2, -157.8, 21.4))
+    monkeypatch.setattr(coastal, 'overview', lambda files, b: bands[files[0]])
+
+    kept, skipped = prefilter([['coast.tif'], ['land.tif'], ['empty.tif']],
+                              [1, 8], INDEX, distance=100, min_fraction=0.001)
+
+    assert kept == [['coast.tif']]
+    assert skipped == [{'tile': 'land.tif', 'reason': 'no water'},
+                       {'tile': 'empty.tif', 'reason': 'no data'}]
+
+
+def test_prefilter_falls_back_to_scene_footprint():
+    # Neither the bounds nor the bands can be read here, only the footprint
+    # decides.
+    tiles = [['/nonexistent/a.tif']]
+
+    assert prefilter(tiles, [1, 8], INDEX, box(-100.1, 40, -100, 40.1),
+                     100) == (
+        [], [{'tile': 'a.tif', 'reason': 'no station within 100 km'}])
+    assert prefilter(tiles, [1, 8], INDEX, box(-71.1, 42.3, -71.0, 42.4),
+                     100) == (tiles, [])
+
+
+def test_prefilter_without_proximity():
+    tiles = [['/nonexistent/a.tif']]
+
+    assert prefilter(tiles, [1, 8], INDEX, box(-100.1, 40, -100, 40.1),
+                     None) == (tiles, [])
+
+
+def test_prefilter_keeps_thin_coast_by_default(monkeypatch):
+    # A 256 pixel tile of sea with a 33 pixel strip of beach, 99.95% water.
+    green = np.full((256, 256), 30, dtype=np.uint16)
+    nir = np.full((256, 256), 10, dtype=np.uint16)
+    nir[0, :33] = 40
+    tiles = [['sea.tif'], ['empty.tif']]
+    monkeypatch.setattr(coastal, 'overview', lambda files, b: (
+        (green, nir, 0) if files[0] == 'sea.tif' else (green * 0, nir * 0, 0)))
+
+    assert water_fraction(green, nir) > 0.9994
+    assert prefilter(tiles, [1, 8], INDEX, distance=None,
+                     min_fraction=None) == (
+        [['sea.tif']], [{'tile': 'empty.tif', 'reason': 'no data'}])
+    assert prefilter(tiles, [1, 8], INDEX, distance=None,
+                     min_fraction=0.001)[0] == []
@@ -0,0 +1,99 @@
+import json
+import math
+
+import geojson_stream
+from geojson_stream import centroids, enrich, iter_features
+
+
+def _write(tmpdir, features, **members):
+    collection = dict(members, type='FeatureCollection', features=features)
+    path = tmpdir.join('bf.geojson')
+    path.write(json.dumps(collection, indent=1))
+    return str(path)
+
+
+def _features(n):
+    return [{'type': 'Feature', 'properties': {'id': i, 'note': u'caf\xe9 "x"'},
+             'geometry': {'type': 'LineString',
+                          'coordinates': [[i, 1.25], [i + 1, -2e-7]]}}
+            for i in range(n)]
+
+
+def test_iter_features_across_buffers(tmpdir, monkeypatch):
+    monkeypatch.setattr(geojson_stream, 'BUFFER_SIZE', 7)
+    path = _write(tmpdir, _features(25), crs={'type': 'name'}, bbox=[0, 1, 2, 3])
+
+    members = {}
+    with open(path) as f:
+        features = list(iter_features(f, members))
+
+    assert features == _features(25)
+    assert members == {'type': 'FeatureCollection', 'crs': {'type': 'name'},
+                       'bbox': [0, 1, 2, 3]}
+
+
+def test_enrich_modes(tmpdir):
+    record = {'identifier': '1030010', 'properties': {'platformName': 'X'}}
+    tides = {'currentTide': 0.5}
+    path = _write(tmpdir, _features(3), crs={'type': 'name'})
+    out_file = str(tmpdir.join('out.geojson'))
+
+    assert enrich(path, out_file, record, tides, 'full') == 3
+    out = json.load(open(out_file))
+    assert out['crs'] == {'type': 'name'}
+    assert all(f['properties'] == {'metadata': record, 'tides': tides}
+               for f in out['features'])
+
+    enrich(path, out_file, record, tides, 'reference')
+    out = json.load(open(out_file))
+    assert out['properties'] == {'metadata': record, 'tides': tides}
+    assert out['features'][0]['properties'] == {'catalog_id': '1030010',
+                                                'tides': tides}
+
+    enrich(path, out_file, record, tides, 'collection')
+    out = json.load(open(out_file))
+    assert out['properties']['tides'] == tides
+    assert out['features'] == _features(3)
+
+
+def test_enrich_empty(tmpdir):
+    path = _write(tmpdir, [])
+    out_file = str(tmpdir.join('out.geojson'))
+
+    assert enrich(path, out_file, {}, {}) == 0
+    assert json.load(open(out_file))['features'] == []
+
+
+def test_centroids(tmpdir):
+    features = _features(2) + [
+        {'type': 'Feature', 'properties': {}, 'geometry': None},
+        {'type': 'Feature', 'properties': {},
+         'geometry': {'type': 'MultiLineString',
+                      'coordinates': [[[0, 0], [2, 0]], [[2, 4], [0, 4]]]}}]
+    path = _write(tmpdir, features)
+
+    lats, lons = centroids(path)
+
+    assert lons[:2] == [0.5, 1.5]
+    assert lats[:2] == [(1.25 - 2e-7) / 2] * 2
+    assert math.isnan(lats[2]) and math.isnan(lons[2])
+    assert (lats[3], lons[3]) == (2, 1)
+
+
+def test_enrich_feature_tides(tmpdir):
+    record = {'identifier': '1030010'}
+    path = _write(tmpdir, _features(2))
+    out_file = str(tmpdir.join('out.geojson'))
+    scene = {'currentTide': 0.5}
+    features = [{'currentTide': 0.1}, {'currentTide': 0.2}]
+
+    enrich(path, out_file, record, scene, 'full', features)
+    out = json.load(open(out_file))
+    assert [f['properties']['tides'] for f in out['features']] == features
+    assert out['features'][0]['properties']['metadata'] == record
+
+    enrich(path, out_file, record, scene, 'collection', features)
+    out = json.load(open(out_file))
+    assert out['properties']['tides'] == scene
+    assert out['features'][1]['properties'] == dict(_features(2)[1]['properties'],
+                                                    tides=features[1])
@@ -0,0 +1,37 @@
+import pstats
+
+import pytest
+
+from instrument import Stages, profiled
+
+
+def test_stages_record_failures_and_labels():
+    stages = Stages()
+
+    with stages.stage('fast', scene='a'):
+        sum(range(1000))
+    with pytest.raises(ValueError):
+        with stages.stage('broken'):
+            raise ValueError()
+
+    @stages.timed('decorated')
+    def double(x):
+        return 2 * x
+    assert double(3) == 6
+
+    records = stages.report()
+    assert [r['stage'] for r in records] == ['fast', 'broken', 'decorated']
+    assert records[0]['scene'] == 'a' and not records[0]['failed']
+    assert records[1]['failed']
+    assert all(r['seconds'] >= 0 and r['peak_rss_kb'] > 0 for r in records)
+
+
+def test_profiled(tmpdir):
+    out_file = str(tmpdir.join('run.pstats'))
+    with profiled(out_file):
+        sorted(range(1000), reverse=True)
+
+    assert pstats.Stats(out_file).total_calls > 0
+
+    with profiled(None):
+        pass
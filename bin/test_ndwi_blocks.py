@@ -0,0 +1,165 @@
+import json
+
+import numpy as np
+import pytest
+
+import ndwi_blocks
+from ndwi_blocks import (NODATA, SMOOTH_MAX, Stitcher, _imap, area,
+                         contour_block, ndwi_index, otsu, process,
+                         smooth_line, windows)
+
+
+def _lake(size=40, radius=12.0):
+    rows, cols = np.mgrid[:size, :size]
+    distance = np.hypot(rows - size / 2.0, cols - size / 2.0)
+    return (radius - distance).astype(np.float32) / size
+
+
+def _trace(values, block):
+    """Lines of a raster traced block by block and stitched.
+    """
+    ysize, xsize = values.shape
+    stitcher = Stitcher()
+    lines = []
+    for xoff, yoff, width, height in windows(xsize, ysize, block):
+        window = values[yoff:yoff + height + 1, xoff:xoff + width + 1]
+        for keys, points in contour_block(window, 0.0, yoff, xoff, height,
+                                          width, xsize):
+            lines.extend(stitcher.add(keys, points))
+    return lines + stitcher.finish()
+
+
+def test_windows_cover_raster():
+    blocks = windows(2500, 1100, 1024)
+
+    assert len(blocks) == 6
+    assert blocks[-1] == (2048, 1024, 452, 76)
+    assert sum(w * h for (_, _, w, h) in blocks) == 2500 * 1100
+
+
+def test_ndwi_index():
+    green = np.array([[30, 10, 0, 0]], dtype=np.uint16)
+    nir = np.array([[10, 30, 5, 0]], dtype=np.uint16)
+
+    index, valid = ndwi_index(green, nir)
+
+    assert valid.tolist() == [[True, True, False, False]]
+    assert np.allclose(index[valid], [0.5, -0.5])
+    assert (index[~valid] == NODATA).all()
+
+
+def test_otsu_splits_two_modes():
+    values = np.concatenate([np.random.RandomState(0).normal(-0.4, 0.05, 5000),
+                             np.random.RandomState(1).normal(0.3, 0.05, 3000)])
+    histogram = np.histogram(values, bins=2000, range=(-1, 1))[0]
+
+    assert -0.25 < otsu(histogram) < 0.15
+
+
+def test_blocks_stitch_into_one_ring():
+    values = _lake()
+    whole = _trace(values, 64)
+
+    for block in (7, 16, 20):
+        lines = _trace(values, block)
+        assert len(lines) == 1
+        points, closed = lines[0]
+        assert closed
+        assert len(points) == len(whole[0][0])
+        assert abs(area(points) - np.pi * 12 ** 2) < 10
+
+
+def test_nodata_ends_lines():
+    values = _lake()
+    values[:, 20] = NODATA
+
+    lines = _trace(values, 16)
+
+    assert len(lines) == 2
+    assert not any(closed for (_, closed) in lines)
+
+
+def test_smooth_line_cuts_corners():
+    square = [(0, 0), (0, 10), (10, 10), (10, 0), (0, 0)]
+
+    assert smooth_line(square, True, 0.0) == square
+    soft = smooth_line(square, True, 0.5)
+    rounded = smooth_line(square, True, SMOOTH_MAX)
+    assert soft != rounded
+    assert soft[0] == soft[-1] and rounded[0] == rounded[-1]
+    # Cutting corners shrinks the square, more so the higher smooth is.
+    assert 100 > area(soft) > area(rounded) > 75
+
+    # Open lines keep their ends.
+    line = smooth_line(square[:4], False, 1.0)
+    assert line[0] == (0, 0) and line[-1] == (10, 0)
+    assert (10, 10) not in line
+
+
+def _square(x):
+    return x * x
+
+
+def test_imap_bounds_jobs_in_flight():
+    submitted = []
+
+    def jobs():
+        for i in range(40):
+            submitted.append(i)
+            yield i
+
+    results = []
+    for result in _imap(_square, jobs(), 2, ahead=4):
+        assert len(submitted) - len(results) <= 4
+        results.append(result)
+
+    assert results == [i * i for i in range(40)]
+
+
+def test_process(tmpdir):
+    gdal = pytest.importorskip('osgeo.gdal')
+    osr = pytest.importorskip('osgeo.osr')
+
+    # A lake in a 100 x 80 UTM zone 4 scene near Honolulu, 10 m pixels.
+    size = 100
+    rows, cols = np.mgrid[:80, :size]
+    water = np.hypot(rows - 40, cols - 50) < 25
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32604)
+    filename = str(tmpdir.join('scene.tif'))
+    dataset = gdal.GetDriverByName('GTiff').Create(filename, size, 80, 2,
+                                                   gdal.GDT_UInt16)
+    dataset.SetGeoTransform((620000, 10, 0, 2360000, 0, -10))
+    dataset.SetProjection(srs.ExportToWkt())
+    dataset.GetRasterBand(1).WriteArray(np.where(water, 30, 10))
+    dataset.GetRasterBand(2).WriteArray(np.where(water, 10, 30))
+    dataset = None
+
+    ndwi_file = str(tmpdir.join('ndwi.tif'))
+    geojson_file = str(tmpdir.join('bf.geojson'))
+    result = process([filename], [1, 2], ndwi_file, geojson_file, minsize=10,
+                     block=32, processes=2)
+    assert not ndwi_blocks._DATASETS
+
+    assert result['windows'] == 12 and result['features'] == 1
+    index = gdal.Open(ndwi_file).ReadAsArray()
+    assert np.allclose(index[40, 50], 0.5) and np.allclose(index[0, 0], -0.5)
+
+    with open(geojson_file) as f:
+        collection = json.load(f)
+    lons, lats = np.array(
+        collection['features'][0]['geometry']['coordinates']).T
+    # The lake is 500 m across, centred at 620505 E 2359595 N.
+    assert abs(lons.mean() + 157.838) < 0.001
+    assert abs(lats.mean() - 21.334) < 0.001
+    assert lons.ptp() < 0.006 and lats.ptp() < 0.006
+
+    # Smoothing changes the geometry, not the number of lines.
+    smoothed_file = str(tmpdir.join('smoothed.geojson'))
+    assert process([filename], [1, 2], str(tmpdir.join('smoothed.tif')),
+                   smoothed_file, minsize=10, smooth=1.0, block=32,
+                   processes=1)['features'] == 1
+    assert not ndwi_blocks._DATASETS
+    with open(smoothed_file) as f:
+        smoothed = json.load(f)['features'][0]['geometry']['coordinates']
+    assert smoothed != collection['features'][0]['geometry']['coordinates']
@@ -0,0 +1,59 @@
+import json
+
+import pytest
+
+import ndwi_tiles
+from ndwi_tiles import merge_geojson, tile_jobs
+
+
+def _collection(*names):
+    return {
+        'type': 'FeatureCollection',
+        'crs': {'type': 'name', 'properties': {'name': 'EPSG:4326'}},
+        'features': [{'type': 'Feature', 'properties': {'name': name},
+                      'geometry': {'type': 'LineString',
+                                   'coordinates': [[0, 0], [1, 1]]}}
+                     for name in names]
+    }
+
+
+def test_merge_geojson(tmpdir):
+    files = []
+    for i, names in enumerate([['a', 'b'], [], ['c']]):
+        tile = tmpdir.join('bf_%04d.geojson' % i)
+        tile.write(json.dumps(_collection(*names)))
+        files.append(str(tile))
+    out_file = str(tmpdir.join('bf.geojson'))
+
+    assert merge_geojson(files, out_file) == 3
+
+    merged = json.loads(open(out_file).read())
+    assert [f['properties']['name'] for f in merged['features']] == ['a', 'b', 'c']
+    assert merged['crs']['properties']['name'] == 'EPSG:4326'
+
+
+def test_tile_jobs_have_distinct_basenames():
+    jobs = tile_jobs([['a.tif'], ['b.tif'], ['c.tif']], [1, 8], 'out', '1000.0', '1.0')
+
+    assert len(set(job[0] for job in jobs)) == 3
+    assert jobs[1][1:] == (['b.tif'], [1, 8], 'out', 1000.0, 1.0)
+
+
+def test_run_blocks_passes_smooth(monkeypatch):
+    calls = []
+    monkeypatch.setattr(ndwi_tiles, 'blocks',
+                        lambda *args, **kwargs: calls.append(kwargs))
+
+    job = tile_jobs([['a.tif']], [1, 8], 'out', '1000.0', '0.5')[0]
+    assert ndwi_tiles.run_blocks(job, 2)[4] is None
+
+    assert calls == [{'minsize': 1000.0, 'smooth': 0.5, 'processes': 2}]
+
+
+def test_empty_unreadable_tile(tmpdir):
+    pytest.importorskip('osgeo.gdal')
+
+    with pytest.raises(IOError) as error:
+        ndwi_tiles.empty([[str(tmpdir.join('missing.tif'))]], str(tmpdir),
+                         str(tmpdir))
+    assert 'Cannot open' in str(error.value)
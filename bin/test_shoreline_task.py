@@ -0,0 +1,263 @@
+import calendar
+import imp
+import json
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+import pytest
+from pytides import constituent
+from pytides.tide import Tide
+
+from lru_cache import LRUCache
+from station_index import StationIndex, to_xyz
+from tide_fit import read_series
+from tide_store import write_store
+
+task = imp.load_source(
+    'shoreline_task', os.path.join(os.path.dirname(__file__),
+                                   'shoreline-task.py'))
+
+# Honolulu, Boston and a station without data or a model.
+STATIONS = [(1612340, 21.3067, -157.867), (8443970, 42.3539, -71.0503),
+            (9999999, -33.9, 18.4)]
+
+
+def _database(path):
+    conn = sqlite3.connect(path)
+    conn.execute('create table stations (station STRING, lat real, lon real, '
+                 'x real, y real, z real);')
+    conn.execute('create table fdh (station STRING, date, mm real);')
+    conn.execute('create index fdh_station on fdh (station, date);')
+    conn.executemany('insert into stations values (?, ?, ?, ?, ?, ?);', [
+        (s, lat, lon) + tuple(to_xyz([lat], [lon])[0])
+        for (s, lat, lon) in STATIONS])
+
+    t0 = calendar.timegm(datetime(2014, 1, 1).timetuple())
+    conn.executemany('insert into fdh values (?, ?, ?);', [
+        (str(s), t0 + 3600 * h, 1500 + 600 * np.cos(2 * np.pi * h / 12.42))
+        for (s, _, _) in STATIONS[:2] for h in range(48)])
+    conn.commit()
+    conn.close()
+
+
+@pytest.fixture
+def fixtures(tmpdir, monkeypatch):
+    """A database and tide store, with the task's shared state reset to
+    load them; Honolulu and Boston have models.
+    """
+    db_file = str(tmpdir.join('fdh.sqlite'))
+    _database(db_file)
+    store = str(tmpdir.join('tidemodel'))
+    write_store(store, {
+        1612340: Tide(constituents=[constituent._Z0, constituent._M2,
+                                    constituent._K1],
+                      amplitudes=[300.0, 250.0, 150.0],
+                      phases=[0.0, 120.0, 310.0]).model,
+        8443970: Tide(constituents=[constituent._Z0, constituent._M2,
+                                    constituent._S2],
+                      amplitudes=[1500.0, 1400.0, 200.0],
+                      phases=[0.0, 45.0, 200.0]).model})
+
+    monkeypatch.setattr(task, 'DB_FILE', db_file)
+    monkeypatch.setattr(task, 'DB_MODE', 'disk')
+    monkeypatch.setattr(task, 'TIDE_MODEL_FILE', store)
+    monkeypatch.setattr(task, 'TIDE_TABLE_FILE', str(tmpdir.join('none')))
+    for name in ('_DB_CURSOR', '_STATION_INDEX', '_TIDE_MODEL',
+                 '_TIDE_ENGINE', '_TIDE_TABLE'):
+        monkeypatch.setattr(task, name, None)
+    monkeypatch.setattr(task, 'PREDICTION_CACHE', LRUCache(64))
+    return tmpdir
+
+
+def test_tide_coordination_batch(fixtures, monkeypatch):
+    monkeypatch.setattr(task, 'MAX_STATION_DISTANCE', 1000.0)
+    calls = []
+    window_extremes = task.window_extremes
+
+    def counted(stations, t0s):
+        calls.append(list(zip(stations, t0s)))
+        return window_extremes(stations, t0s)
+
+    monkeypatch.setattr(task, 'window_extremes', counted)
+
+    a, b = '2016-05-03-13-42', '2016-05-04-00-00'
+    lats = [21.3, 42.4, 95.0, 21.31, -33.9, 0.0, 21.3]
+    lons = [-157.9, -71.0, 0.0, -157.85, 18.5, -140.0, -157.9]
+    out = task.tide_coordination_batch(lats, lons, [a, a, a, a, a, a, b])
+
+    # One prediction per station and time, however many points share it.
+    assert len(calls) == 1
+    assert sorted(calls[0]) == sorted([
+        (1612340, datetime(2016, 5, 3, 13, 42)),
+        (8443970, datetime(2016, 5, 3, 13, 42)),
+        (1612340, datetime(2016, 5, 4))])
+
+    engine = task.get_tide_engine()
+    lows, highs, starts = engine.extreme_points(
+        [1612340, 8443970, 1612340],
+        [datetime(2016, 5, 3, 13, 42)] * 2 + [datetime(2016, 5, 4)],
+        task.PREDICTION_WINDOW)
+    for i, j in ((0, 0), (1, 1), (3, 0), (6, 2)):
+        assert np.allclose([out[i]['minimumTide24Hours'],
+                            out[i]['maximumTide24Hours'],
+                            out[i]['currentTide']],
+                           [lows[j] / 1000, highs[j] / 1000, starts[j] / 1000])
+    assert out[0] == out[3] and out[0] != out[6]
+
+    # An invalid point, a station without a model and a point out of range.
+    null = {'minimumTide24Hours': 'null', 'maximumTide24Hours': 'null',
+            'currentTide': 'null'}
+    assert out[2] == out[4] == out[5] == null
+
+    # Served from the prediction cache the second time.
+    assert task.tide_coordination_batch(lats, lons, [a] * 6 + [b]) == out
+    assert len(calls) == 1
+    assert task.tide_coordination(21.3, -157.9, a) == out[0]
+
+
+@pytest.mark.parametrize('mode', ['disk', 'readonly', 'immutable', 'memory'])
+def test_init_db_modes(tmpdir, mode):
+    db_file = str(tmpdir.join('fdh.sqlite'))
+    _database(db_file)
+    stats = {}
+
+    cursor = task.init_db(db_file, mode=mode, stats=stats)
+
+    if mode == 'immutable' and sys.version_info[0] < 3:
+        assert stats['mode'] == 'readonly'
+    else:
+        assert stats['mode'] == mode
+    index = StationIndex.from_cursor(cursor)
+    assert index.nearest(21.3, -157.9)[0][0] == 1612340
+    dates, heights = read_series(cursor, 8443970)
+    assert len(dates) == len(heights) == 48
+    assert read_series(cursor, 9999999)[0].size == 0
+
+
+def test_init_db_in_mem(tmpdir):
+    db_file = str(tmpdir.join('fdh.sqlite'))
+    _database(db_file)
+    stats = {}
+
+    cursor = task.init_db(db_file, in_mem=True, stats=stats)
+
+    assert stats['mode'] == 'memory'
+    assert len(StationIndex.from_cursor(cursor)) == len(STATIONS)
+
+
+@pytest.mark.parametrize('ports', [{'metadata': 'ful'}, {'tides': 'scenes'}])
+def test_invoke_rejects_unknown_modes(tmpdir, monkeypatch, ports):
+    tmpdir.mkdir('input').join('ports.json').write(json.dumps(
+        dict(ports, cat_id='abc')))
+    monkeypatch.setattr(task.gbdx_auth, 'session_from_existing_token',
+                        lambda token: None)
+
+    def fail(*args, **kwargs):
+        raise AssertionError('scene processed')
+
+    monkeypatch.setattr(task.ShorelineTask, 'process_scene', fail)
+
+    with pytest.raises(ValueError) as error:
+        task.ShorelineTask(str(tmpdir)).invoke()
+    assert 'Unknown' in str(error.value)
+
+
+class _Catalog(object):
+    """Catalog records of scenes over Honolulu; cat ids starting with bad
+    are missing.
+    """
+
+    def __init__(self, session):
+        pass
+
+    def record(self, cat_id):
+        if cat_id.startswith('bad'):
+            raise IOError('No record for %s' % cat_id)
+        return {'identifier': cat_id, 'properties': {
+            'platformName': 'WORLDVIEW02',
+            'footprintWkt': 'POLYGON((-157.9 21.3, -157.8 21.3, '
+                            '-157.8 21.4, -157.9 21.3))',
+            'timestamp': '2016-05-03T13:42:00Z'}}
+
+
+def _ndwi(tiles, bands, vector_dir, raster_dir, minsize, smooth,
+          processes=None):
+    with open(os.path.join(vector_dir, 'bf.geojson'), 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'properties': {}, 'geometry': {
+                'type': 'LineString',
+                'coordinates': [[-157.86, 21.31], [-157.85, 21.32]]}}]}, f)
+
+
+def _batch(work, monkeypatch, cat_ids, ndwi=_ndwi):
+    monkeypatch.setattr(task.gbdx_auth, 'session_from_existing_token',
+                        lambda token: None)
+    monkeypatch.setattr(task, 'CatalogClient', _Catalog)
+    monkeypatch.setattr(task, 'ndwi', ndwi)
+
+    inputs = work.mkdir('input')
+    for i, _ in enumerate(cat_ids):
+        inputs.mkdir('image_%d' % (10 * i or 1)).join('tile.tif').write('')
+    inputs.join('ports.json').write(json.dumps(
+        {'cat_ids': ', '.join(cat_ids), 'tides': 'feature'}))
+
+    with task.ShorelineTask(str(work)) as t:
+        t.invoke()
+    return json.loads(work.join('status.json').read())
+
+
+def test_invoke_batch(fixtures, monkeypatch):
+    status = _batch(fixtures, monkeypatch, ['c1', 'bad', 'c3'])
+
+    assert status['status'] == 'success'
+    assert status['reason'] == 'Created shoreline GeoJSON for 2 of 3 scenes'
+    scenes = status['scenes']
+    # image_1, image_10, image_20 in port name order.
+    assert [(s['cat_id'], s['image'], s['status']) for s in scenes] == [
+        ('c1', 'image_1', 'success'), ('bad', 'image_10', 'failed'),
+        ('c3', 'image_20', 'success')]
+    assert scenes[0]['tiles'] == {'tiles': 1, 'skipped': []}
+    assert scenes[1]['reason'].endswith('No record for bad')
+
+    with open(str(fixtures.join('output', 'vector', 'c3', 'bf.geojson'))) as f:
+        feature = json.load(f)['features'][0]
+    assert feature['properties']['tides']['currentTide'] != 'null'
+    assert not fixtures.join('output', 'vector', 'bad').check()
+
+
+def test_invoke_batch_fails_when_every_scene_does(fixtures, monkeypatch):
+    status = _batch(fixtures, monkeypatch, ['bad1', 'bad2'])
+
+    assert status['status'] == 'failed'
+    assert [s['status'] for s in status['scenes']] == ['failed', 'failed']
+
+
+
+def test_invoke_batch_runs_ndwi_one_scene_at_a_time(fixtures, monkeypatch):
+    monkeypatch.setattr(task, 'SCENE_WORKERS', 3)
+    running = []
+    most = []
+
+    def ndwi(*args, **kwargs):
+        running.append(None)
+        most.append(len(running))
+        time.sleep(0.05)
+        _ndwi(*args, **kwargs)
+        running.pop()
+
+    status = _batch(fixtures, monkeypatch, ['c1', 'c2', 'c3'], ndwi)
+
+    assert [s['status'] for s in status['scenes']] == ['success'] * 3
+    assert most == [1, 1, 1]
+
+
+@pytest.mark.parametrize('cat_id', ['../c1', 'c1/x', '.', 'c1;x'])
+def test_invoke_batch_rejects_bad_cat_ids(fixtures, monkeypatch, cat_id):
+    with pytest.raises(ValueError) as error:
+        _batch(fixtures, monkeypatch, ['c2', cat_id])
+    assert 'Invalid catalog ids' in str(error.value)
+    assert not fixtures.join('output', 'vector', 'c2').check()
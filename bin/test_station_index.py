@@ -0,0 +1,82 @@
+import sqlite3
+
+import numpy as np
+
+from station_index import StationIndex, EARTH_RADIUS
+
+
+def _index():
+    conn = sqlite3.connect(':memory:')
+    cursor = conn.cursor()
+    cursor.execute('create table stations (station, lat real, lon real);')
+    cursor.executemany('insert into stations values (?, ?, ?);',
+                       [(1, 0.0, 0.0), (2, 0.0, 10.0), (3, 45.0, -179.5),
+                        (4, -33.9, 18.4)])
+    return StationIndex.from_cursor(cursor)
+
+
+def test_nearest():
+    index = _index()
+
+    assert index.nearest(1.0, 1.0)[0][0] == 1
+    assert index.nearest(0.0, 8.0)[0][0] == 2
+    # Across the antimeridian.
+    assert index.nearest(44.0, 179.9)[0][0] == 3
+
+
+def test_k_nearest_distances():
+    index = _index()
+
+    found = index.nearest(0.0, 4.0, k=2)
+
+    assert [station for (station, _) in found] == [1, 2]
+    np.testing.assert_allclose([d for (_, d) in found],
+                               [np.radians(4.0) * EARTH_RADIUS,
+                                np.radians(6.0) * EARTH_RADIUS])
+
+
+def test_max_distance():
+    index = _index()
+
+    assert index.nearest(0.0, 4.0, max_distance=500.0)[0][0] == 1
+    assert index.nearest(0.0, 4.0, max_distance=400.0) == []
+
+
+def test_query_invalid_points():
+    index = _index()
+
+    found, distance = index.query([None, 91.0, 0.0], [0.0, 0.0, 0.0])
+
+    assert list(found[:, 0]) == [len(index), len(index), 0]
+    assert np.isinf(distance[:2]).all()
+
+
+def test_from_cursor_unit_vectors():
+    conn = sqlite3.connect(':memory:')
+    cursor = conn.cursor()
+    cursor.execute('create table stations (station, lat real, lon real, '
+                   'x real, y real, z real);')
+    cursor.executemany('insert into stations values (?, ?, ?, ?, ?, ?);',
+                       [(1, 0.0, 0.0, 1.0, 0.0, 0.0),
+                        (2, 90.0, 0.0, 0.0, 0.0, 1.0)])
+    index = StationIndex.from_cursor(cursor)
+
+    assert index.nearest(80.0, 100.0)[0][0] == 2
+    assert index.nearest(10.0, 5.0)[0][0] == 1
+
+
+def test_from_cursor_row_factory():
+    # init_db reads through sqlite3.Row in memory mode, which cannot be
+    # sliced on Python 2.
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    cursor.execute('create table stations (station, lat real, lon real, '
+                   'x real, y real, z real);')
+    cursor.executemany('insert into stations values (?, ?, ?, ?, ?, ?);',
+                       [(1, 0.0, 0.0, 1.0, 0.0, 0.0),
+                        (2, 90.0, 0.0, 0.0, 0.0, 1.0)])
+    index = StationIndex.from_cursor(cursor)
+
+    assert index.stations == [1, 2]
+    assert index.nearest(80.0, 100.0)[0][0] == 2
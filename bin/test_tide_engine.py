@@ -0,0 +1,115 @@
+from datetime import datetime
+
+import numpy as np
+from pytides import constituent
+from pytides.tide import Tide
+
+from tide_engine import TideEngine, TOLERANCE
+
+
+def _models():
+    return {
+        1: Tide(constituents=[constituent._Z0, constituent._M2, constituent._K1],
+                amplitudes=[1500.0, 600.0, 250.0],
+                phases=[0.0, 120.0, 310.0]),
+        2: Tide(constituents=[constituent._Z0, constituent._S2, constituent._O1,
+                              constituent._M4],
+                amplitudes=[900.0, 200.0, 180.0, 40.0],
+                phases=[0.0, 45.0, 200.0, 10.0]),
+        3: None,
+    }
+
+
+def test_predict_matches_tide_at():
+    models = _models()
+    engine = TideEngine.from_models(models)
+    t0 = datetime(2016, 5, 3, 13, 42)
+    # Long enough to span several node factor partitions.
+    hours = 0.5 * np.arange(1200)
+
+    heights = engine.predict(t0, hours)
+
+    assert engine.stations == [1, 2]
+    for row, station in enumerate(engine.stations):
+        expected = models[station].at(Tide._times(t0, hours))
+        assert np.abs(heights[row] - expected).max() < TOLERANCE
+
+
+def test_predict_station_subset():
+    models = _models()
+    engine = TideEngine.from_models(models)
+    t0 = datetime(2017, 1, 1)
+    hours = [2.0, 2.5, 30.0]
+
+    heights = engine.predict(t0, hours, [2])
+
+    expected = models[2].at(Tide._times(t0, hours))
+    assert heights.shape == (1, 3)
+    assert np.abs(heights[0] - expected).max() < TOLERANCE
+    assert 3 not in engine
+
+
+def test_predict_points_matches_tide_at():
+    models = _models()
+    engine = TideEngine.from_models(models)
+    stations = [2, 1, 2]
+    t0s = [datetime(2015, 3, 1, 6, 30), datetime(2016, 8, 9, 22, 0),
+           datetime(2015, 3, 1, 6, 30)]
+    hours = 0.1 * np.arange(240)
+
+    heights = engine.predict_points(stations, t0s, hours)
+
+    for row, (station, t0) in enumerate(zip(stations, t0s)):
+        expected = models[station].at(Tide._times(t0, hours))
+        assert np.abs(heights[row] - expected).max() < TOLERANCE
+
+
+def test_extrema_are_stationary_points():
+    models = _models()
+    engine = TideEngine.from_models(models)
+    t0 = datetime(2016, 5, 3, 13, 42)
+
+    times, heights, highs = engine.extrema(2, t0, 300.0)
+
+    # Two highs and two lows a day, alternating.
+    assert 45 <= len(times) <= 55
+    assert (np.diff(times) > 0).all()
+    assert (highs[1:] != highs[:-1]).all()
+    for t, h, high in zip(times, heights, highs):
+        around = models[2].at(Tide._times(t0, [0, t - 0.01, t, t + 0.01]))[1:]
+        assert abs(around[1] - h) < TOLERANCE
+        if high:
+            assert h >= around.max() - TOLERANCE
+        else:
+            assert h <= around.min() + TOLERANCE
+
+
+def test_extreme_points_bound_dense_sampling():
+    models = _models()
+    engine = TideEngine.from_models(models)
+    stations = [1, 2]
+    t0s = [datetime(2015, 3, 1, 6, 30), datetime(2016, 8, 9, 22, 0)]
+    hours = 0.01 * np.arange(2401)
+
+    lows, highs, starts = engine.extreme_points(stations, t0s, 24.0)
+
+    dense = engine.predict_points(stations, t0s, hours)
+    assert (lows <= dense.min(axis=1)).all()
+    assert (highs >= dense.max(axis=1)).all()
+    assert np.abs(lows - dense.min(axis=1)).max() < 1e-2
+    assert np.abs(highs - dense.max(axis=1)).max() < 1e-2
+    assert np.abs(starts - dense[:, 0]).max() < TOLERANCE
+
+
+def test_series_chunks_match_tide_at():
+    models = _models()
+    engine = TideEngine.from_models(models)
+    t0 = datetime(2016, 5, 3, 13, 42)
+
+    chunks = list(engine.series(2, t0, 600.0, 0.7, chunk=100))
+    offsets, heights = [np.concatenate(x) for x in zip(*chunks)]
+
+    assert [len(c[0]) for c in chunks] == [100] * 8 + [58]
+    assert np.allclose(offsets, 0.7 * np.arange(858))
+    expected = models[2].at(Tide._times(t0, offsets))
+    assert np.abs(heights - expected).max() < TOLERANCE
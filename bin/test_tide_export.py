@@ -0,0 +1,50 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+from pytides import constituent
+from pytides.tide import Tide
+
+from tide_engine import TideEngine
+from tide_export import export
+
+T0 = datetime(2016, 5, 3, 13, 42)
+
+
+def _engine():
+    return TideEngine.from_models({
+        1: Tide(constituents=[constituent._Z0, constituent._M2],
+                amplitudes=[1500.0, 600.0], phases=[0.0, 120.0])})
+
+
+def test_export_npy(tmpdir):
+    out_file = str(tmpdir.join('series.npy'))
+
+    assert export(_engine(), 1, T0, 1000.0, 0.1, out_file) == 10001
+
+    series = np.load(out_file, mmap_mode='r')
+    heights = _engine().predict(T0, 0.1 * np.arange(10001))[0] / 1000
+    assert series['time'][0] == 1462282920
+    assert series['time'][-1] - series['time'][0] == 1000 * 3600
+    assert np.abs(series['height'] - heights).max() < 1e-9
+
+
+def test_export_csv(tmpdir):
+    out_file = str(tmpdir.join('series.txt'))
+
+    assert export(_engine(), 1, T0, 1.0, 0.5, out_file, 'csv') == 3
+
+    lines = open(out_file).read().splitlines()
+    assert lines[0] == 'time,height'
+    assert [line.split(',')[0] for line in lines[1:]] == [
+        '2016-05-03T13:42:00Z', '2016-05-03T14:12:00Z', '2016-05-03T14:42:00Z']
+
+
+@pytest.mark.parametrize('hours, step', [(0, 0.1), (-1.0, 0.1), (1.0, 0),
+                                         (1.0, -0.1)])
+def test_export_rejects_empty_range(tmpdir, hours, step):
+    out_file = str(tmpdir.join('series.csv'))
+
+    with pytest.raises(ValueError):
+        export(_engine(), 1, T0, hours, step, out_file)
+    assert not tmpdir.join('series.csv').check()
@@ -0,0 +1,121 @@
+import calendar
+import math
+import sqlite3
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from tide_engine import TideEngine
+from tide_fit import fit_models, fit_series, read_series
+from tide_store import TideStore
+
+
+def _database(path, offset=0.0):
+    conn = sqlite3.connect(path)
+    conn.execute('create table stations (station STRING, lat real, lon real);')
+    conn.execute('create table fdh (station STRING, date, mm real);')
+    conn.executemany('insert into stations values (?, 0, 0);', [(1,), (2,), (3,)])
+
+    t0 = datetime(2014, 1, 1)
+    for station in (1, 2):
+        conn.executemany('insert into fdh values (?, ?, ?);', [
+            (station, calendar.timegm((t0 + timedelta(hours=h)).timetuple()),
+             1500 + offset * (station == 2) +
+             600 * math.cos(2 * math.pi * h / 12.42 + station))
+            for h in range(24 * 10)])
+    conn.commit()
+    conn.close()
+
+
+def test_fit_models(tmpdir):
+    db_file = str(tmpdir.join('fdh.sqlite'))
+    path = str(tmpdir.join('tidemodel'))
+    _database(db_file)
+
+    report = fit_models(db_file, path, processes=2)
+
+    store = TideStore(path)
+    assert store.stations == [1, 2]
+    assert sorted(r['station'] for r in report) == [1, 2, 3]
+    assert [r['station'] for r in report if r['error']] == [3]
+    assert abs(store.model(1)['amplitude'][0] - 1500) < 10
+
+
+def test_fit_models_incremental(tmpdir):
+    db_file = str(tmpdir.join('fdh.sqlite'))
+    path = str(tmpdir.join('tidemodel'))
+    _database(db_file)
+    fit_models(db_file, path, processes=1)
+
+    conn = sqlite3.connect(db_file)
+    conn.execute('update fdh set mm = mm + 100 where station = 2;')
+    conn.commit()
+    conn.close()
+
+    report = fit_models(db_file, path, incremental=True, processes=1)
+
+    store = TideStore(path)
+    assert [r['station'] for r in report] == [2]
+    assert store.stations == [1, 2]
+    assert abs(store.model(2)['amplitude'][0] - 1600) < 10
+
+
+def test_read_series(tmpdir):
+    db_file = str(tmpdir.join('fdh.sqlite'))
+    _database(db_file)
+    cursor = sqlite3.connect(db_file).cursor()
+
+    dates, heights = read_series(cursor, 2, datetime(2014, 1, 2),
+                                 datetime(2014, 1, 2, 3))
+
+    assert dates.dtype == 'int64' and heights.dtype == 'float64'
+    assert list(dates.astype('datetime64[s]').astype(datetime)) == [
+        datetime(2014, 1, 2, h) for h in range(3)]
+    assert read_series(cursor, 3)[0].size == 0
+
+
+def test_read_series_row_factory(tmpdir):
+    db_file = str(tmpdir.join('fdh.sqlite'))
+    _database(db_file)
+    conn = sqlite3.connect(db_file)
+    conn.row_factory = sqlite3.Row
+
+    dates, heights = read_series(conn.cursor(), 1)
+
+    assert len(dates) == len(heights) == 24 * 10
+
+
+def _series(days, noise=0.0):
+    dates = calendar.timegm(datetime(2014, 1, 1).timetuple()) + \
+        3600 * np.arange(24 * days, dtype=np.int64)
+    hours = (dates - dates[0]) / 3600.0
+    heights = (1500 + 600 * np.cos(2 * np.pi * hours / 12.42 + 1) +
+               200 * np.cos(2 * np.pi * hours / 23.93) +
+               np.random.RandomState(0).normal(0, noise, len(hours)))
+    return dates, heights
+
+
+def test_lstsq_matches_pytides():
+    dates, heights = _series(40, noise=30)
+
+    lstsq, lstsq_rms = fit_series(dates, heights)
+    pytides, pytides_rms = fit_series(dates, heights, 'pytides')
+
+    assert [c.name for c in lstsq['constituent']] == \
+        [c.name for c in pytides['constituent']]
+    engine = TideEngine.from_models({1: lstsq, 2: pytides})
+    predicted = engine.predict(datetime(2014, 3, 1), np.arange(0, 500, 0.25))
+    assert np.abs(predicted[0] - predicted[1]).max() < 0.01
+    assert abs(lstsq_rms - pytides_rms) < 1e-3
+    assert 25 < lstsq_rms < 30
+
+
+def test_fit_window_and_decimation():
+    dates, heights = _series(400)
+
+    full, _ = fit_series(dates, heights)
+    recent, rms = fit_series(dates, heights, window_days=60, decimate=2)
+
+    assert rms < 5
+    assert abs(recent['amplitude'][0] - 1500) < 5
+    assert len(recent) < len(full)
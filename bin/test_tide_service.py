@@ -0,0 +1,116 @@
+import json
+import threading
+
+import pytest
+import requests
+
+from tide_service import MicroBatcher, TideService
+
+
+def _echo(lats, lons, dtgs):
+    if any(lat > 90 for lat in lats):
+        raise ValueError('bad latitude')
+    return [{'lat': lat, 'lon': lon, 'dtg': dtg}
+            for (lat, lon, dtg) in zip(lats, lons, dtgs)]
+
+
+def test_micro_batches_concurrent_queries():
+    calls = []
+
+    def batch(lats, lons, dtgs):
+        calls.append(len(lats))
+        return _echo(lats, lons, dtgs)
+
+    batcher = MicroBatcher(batch, max_batch=8, max_wait=0.2)
+    results = [None] * 20
+
+    def query(i):
+        results[i] = batcher(float(i), -float(i), 'dtg%d' % i)
+
+    threads = [threading.Thread(target=query, args=(i,)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [{'lat': float(i), 'lon': -float(i), 'dtg': 'dtg%d' % i}
+                       for i in range(20)]
+    assert sum(calls) == 20 and max(calls) <= 8 and len(calls) < 20
+    assert batcher.stats()['queries'] == 20
+
+
+def test_failed_query_does_not_fail_its_batch():
+    calls = []
+
+    def batch(lats, lons, dtgs):
+        calls.append(len(lats))
+        return _echo(lats, lons, dtgs)
+
+    batcher = MicroBatcher(batch, max_batch=8, max_wait=0.5)
+    results = {}
+
+    def query(lat):
+        try:
+            results[lat] = batcher(lat, 0.0)
+        except ValueError as e:
+            results[lat] = str(e)
+
+    threads = [threading.Thread(target=query, args=(lat,))
+               for lat in (10.0, 95.0, 20.0)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert calls[0] == 3
+    assert results == {10.0: {'lat': 10.0, 'lon': 0.0, 'dtg': None},
+                       95.0: 'bad latitude',
+                       20.0: {'lat': 20.0, 'lon': 0.0, 'dtg': None}}
+    assert batcher.stats()['errors'] == 1
+
+
+@pytest.fixture
+def service():
+    server = TideService(('127.0.0.1', 0), MicroBatcher(_echo, max_wait=0.001),
+                         lambda: {'cache': {'hits': 1}})
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:%d' % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def test_endpoints(service):
+    r = requests.get(service + '/tide', params={'lat': 21.3, 'lon': -157.9,
+                                                'dtg': '2016-05-03-13-42'})
+    assert r.json() == {'lat': 21.3, 'lon': -157.9, 'dtg': '2016-05-03-13-42'}
+
+    r = requests.post(service + '/tides', data=json.dumps(
+        {'points': [{'lat': 1, 'lon': 2},
+                    {'lat': 3, 'lon': 4, 'dtg': '2016-05-03-13-42'}]}))
+    assert [p['lat'] for p in r.json()] == [1, 3]
+    r = requests.post(service + '/tides', data=json.dumps(
+        {'points': [{'lat': 1, 'lon': 2, 'dtg': 'garbage'}]}))
+    assert r.status_code == 400
+
+    assert requests.get(service + '/tide', params={'lat': 95, 'lon': 0}).status_code == 500
+    assert requests.get(service + '/tide', params={'lon': 0}).status_code == 400
+    assert requests.get(service + '/tide', params={
+        'lat': 0, 'lon': 0, 'dtg': 'garbage'}).status_code == 400
+    assert requests.get(service + '/health').json()['status'] == 'ok'
+
+    metrics = requests.get(service + '/metrics').json()
+    assert metrics['batching']['queries'] == 2
+    assert metrics['batching']['errors'] == 1
+    assert metrics['cache'] == {'hits': 1}
+
+
+def test_short_batch_results_are_errors():
+    batcher = MicroBatcher(lambda lats, lons, dtgs: _echo(lats, lons, dtgs)[1:],
+                           max_wait=0.001)
+
+    with pytest.raises(ValueError) as error:
+        batcher(1.0, 2.0)
+    assert 'results' in str(error.value)
+    assert batcher.stats()['errors'] == 1
@@ -0,0 +1,86 @@
+import json
+import os
+from datetime import datetime
+
+import numpy as np
+import pytest
+from pytides import constituent
+from pytides.tide import Tide
+
+from tide_store import TideStore, write_store, COEFFICIENTS_FILE, INDEX_FILE
+
+
+def _models():
+    return {
+        7: Tide(constituents=[constituent._Z0, constituent._M2, constituent._K1],
+                amplitudes=[1500.0, 600.0, 250.0],
+                phases=[0.0, 120.0, 310.0]).model,
+        9: None,
+    }
+
+
+def test_round_trip(tmpdir):
+    path = str(tmpdir.join('tidemodel'))
+    models = _models()
+
+    write_store(path, models)
+    store = TideStore(path)
+
+    assert store.stations == [7]
+    assert 9 not in store
+
+    times = Tide._times(datetime(2016, 1, 1), 0.1 * np.arange(240))
+    expected = Tide(model=models[7], radians=False).at(times)
+    np.testing.assert_allclose(store[7].at(times), expected)
+    assert [c.name for c in store.model(7)['constituent']] == ['Z0', 'M2', 'K1']
+
+
+def test_missing_store(tmpdir):
+    with pytest.raises(IOError):
+        TideStore(str(tmpdir.join('missing')))
+
+
+def test_unknown_version(tmpdir):
+    path = str(tmpdir.join('tidemodel'))
+    write_store(path, _models())
+
+    with open(os.path.join(path, INDEX_FILE)) as f:
+        index = json.load(f)
+    index['version'] = 0
+    with open(os.path.join(path, INDEX_FILE), 'w') as f:
+        json.dump(index, f)
+
+    with pytest.raises(ValueError):
+        TideStore(path)
+
+
+def test_rewrite_under_reader(tmpdir):
+    path = str(tmpdir.join('tidemodel'))
+    models = _models()
+    write_store(path, models)
+    store = TideStore(path)
+    amplitude = np.array(store.amplitude)
+
+    models[7]['amplitude'] *= 2
+    write_store(path, models)
+    write_store(path, models)
+
+    # The open store still reads its own coefficients.
+    np.testing.assert_array_equal(store.amplitude, amplitude)
+    np.testing.assert_array_equal(TideStore(path).amplitude, 2 * amplitude)
+    # Only the current and previous coefficients are left.
+    assert len([f for f in os.listdir(path) if f.endswith('.npy')]) == 2
+
+
+def test_unnamed_coefficients(tmpdir):
+    path = str(tmpdir.join('tidemodel'))
+    write_store(path, _models())
+
+    with open(os.path.join(path, INDEX_FILE)) as f:
+        index = json.load(f)
+    os.rename(os.path.join(path, index.pop('coefficients')),
+              os.path.join(path, COEFFICIENTS_FILE))
+    with open(os.path.join(path, INDEX_FILE), 'w') as f:
+        json.dump(index, f)
+
+    assert TideStore(path).stations == [7]
@@ -0,0 +1,64 @@
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+from pytides import constituent
+from pytides.tide import Tide
+
+from tide_engine import TideEngine
+from tide_table import TideTable, build_table, model_checksum
+
+
+def _engine():
+    return TideEngine.from_models({
+        1: Tide(constituents=[constituent._Z0, constituent._M2, constituent._K1],
+                amplitudes=[1500.0, 600.0, 250.0], phases=[0.0, 120.0, 310.0]),
+        2: Tide(constituents=[constituent._Z0, constituent._S2, constituent._O1],
+                amplitudes=[900.0, 200.0, 180.0], phases=[0.0, 45.0, 200.0])})
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_table_matches_engine(tmpdir, processes):
+    engine = _engine()
+    start = datetime(2016, 1, 1)
+    table = build_table(str(tmpdir), engine, start, datetime(2016, 3, 1),
+                        processes=processes)
+
+    assert table.slots == 60 * 240 + 1
+    assert TideTable(str(tmpdir)).checksum == model_checksum(engine)
+
+    stations = [1, 2, 1, 2]
+    t0s = [start, datetime(2016, 1, 17, 3, 41), datetime(2016, 2, 2, 0, 3),
+           datetime(2016, 2, 29)]
+
+    expected = engine.extreme_points(stations, t0s, 24.0)
+    actual = table.extreme_points(stations, t0s, 24.0)
+    for a, e in zip(actual, expected):
+        assert np.abs(a - e).max() < 1.0
+
+
+def test_covers(tmpdir):
+    start = datetime(2016, 1, 1)
+    table = build_table(str(tmpdir), _engine(), start, start + timedelta(days=2),
+                        processes=1)
+
+    assert table.covers(start, 48)
+    assert table.covers(start + timedelta(hours=3), 24)
+    assert not table.covers(start + timedelta(hours=25), 24)
+    assert not table.covers(start - timedelta(minutes=1), 1)
+
+
+def test_rebuild_under_reader(tmpdir):
+    start = datetime(2016, 1, 1)
+    table = build_table(str(tmpdir), _engine(), start, start + timedelta(days=1),
+                        processes=1)
+    heights = np.array(table.heights)
+
+    rebuilt = build_table(str(tmpdir), _engine(), start,
+                          start + timedelta(days=2), processes=1)
+
+    np.testing.assert_array_equal(table.heights, heights)
+    assert rebuilt.slots == 2 * table.slots - 1
+    np.testing.assert_array_equal(rebuilt.heights[:, :table.slots], heights)
+    assert len([f for f in os.listdir(str(tmpdir)) if f.endswith('.npy')]) == 2
@@ -0,0 +1,105 @@
+"""Export long tide time series, one chunk at a time.
+
+Predictions come from TideEngine.series and are written as they are
+generated, to CSV or to a NumPy .npy file of records, so memory stays flat
+however long the range.  The .npy file can be opened with
+numpy.load(filename, mmap_mode='r').
+
+    python shoreline-task.py export --station 8443970 \\
+        --start 2016-01-01-00-00 --end 2017-01-01-00-00 --step 6 \\
+        --out boston.csv
+"""
+from datetime import datetime
+
+import numpy as np
+
+from tide_engine import series_length
+
+FORMATS = ('csv', 'npy')
+
+# Records of the .npy output: time in epoch seconds UTC, height in meters.
+DTYPE = np.dtype([('time', '<i8'), ('height', '<f8')])
+EPOCH = datetime(1970, 1, 1)
+
+
+def _records(t0, chunks):
+    """Epoch seconds and heights in meters of each chunk of a series.
+    """
+    start = (t0 - EPOCH).total_seconds()
+    for offsets, heights in chunks:
+        yield (np.round(start + 3600 * offsets).astype(np.int64),
+               heights / 1000)
+
+
+def write_csv(f, t0, chunks):
+    """Write a series as CSV with an ISO 8601 time and a height in meters.
+    :param f: file object open for writing
+    :param t0: datetime of the first sample
+    :param chunks: iterable of (hours after t0, heights in mm), see
+        TideEngine.series
+    :returns: number of rows written
+    """
+    f.write('time,height\n')
+    count = 0
+    for seconds, heights in _records(t0, chunks):
+        times = seconds.astype('datetime64[s]').astype(str)
+        f.write(''.join('%sZ,%.4f\n' % row for row in zip(times, heights)))
+        count += len(seconds)
+
+    return count
+
+
+def write_npy(filename, t0, count, chunks):
+    """Write a series as a .npy file of DTYPE records.
+    The header is written first and the records appended chunk by chunk,
+    rather than filling a memory map whose dirty pages would accumulate.
+    :param count: number of samples, see tide_engine.series_length
+    :returns: number of records written
+    :raises ValueError: if the chunks do not hold count samples
+    """
+    written = 0
+    with open(filename, 'wb') as f:
+        np.lib.format.write_array_header_1_0(f, {
+            'descr': np.lib.format.dtype_to_descr(DTYPE),
+            'fortran_order': False,
+            'shape': (count,)
+        })
+        for seconds, heights in _records(t0, chunks):
+            records = np.empty(len(seconds), dtype=DTYPE)
+            records['time'] = seconds
+            records['height'] = heights
+            f.write(records.tobytes())
+            written += len(records)
+
+    if written != count:
+        raise ValueError('Wrote %d of %d records' % (written, count))
+    return written
+
+
+def export(engine, station, t0, hours, step, out_file, fmt=None):
+    """Predict a station over a range and write the series to out_file.
+    :param engine: TideEngine
+    :param t0: datetime of the first sample
+    :param hours: length of the range
+    :param step: hours between samples
+    :param fmt: one of FORMATS (default: from the extension of out_file)
+    :returns: number of samples written
+    :raises ValueError: for an unknown format, or a range or step that is
+        not positive
+    """
+    if hours <= 0:
+        raise ValueError('Range must be positive, got %s hours' % hours)
+    if step <= 0:
+        raise ValueError('Step must be positive, got %s hours' % step)
+    if fmt is None:
+        fmt = 'npy' if out_file.endswith('.npy') else 'csv'
+    if fmt not in FORMATS:
+        raise ValueError('Unknown format %s, expected one of %s' %
+                         (fmt, ', '.join(FORMATS)))
+
+    chunks = engine.series(station, t0, hours, step)
+    if fmt == 'npy':
+        return write_npy(out_file, t0, series_length(hours, step), chunks)
+
+    with open(out_file, 'w') as f:
+        return write_csv(f, t0, chunks)
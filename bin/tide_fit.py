@@ -0,0 +1,345 @@
+"""Fit tide models for the stations in the gauge database.
+
+Stations are fitted in parallel over a process pool.  Every station's series
+is summarized by a fingerprint kept in the tide store, so an incremental run
+only refits the stations whose data changed since the store was written.
+
+The default fit is a linear least squares solve: with the speeds, equilibrium
+arguments and node factors fixed as in Tide.decompose, each constituent's
+H cos(arg - p) is linear in H cos p and H sin p.  The design matrix is built
+with NumPy a block of rows at a time and the normal equations solved once,
+which gives the same models as the iterative Tide.decompose.  A fit can be
+limited to the most recent days of a series, or to every n-th sample, and
+reports the residual RMS over the whole window, so accuracy can be traded for
+speed knowingly.
+
+    python tide_fit.py fdh.sqlite tidemodel [--incremental] [--processes N]
+        [--method lstsq|pytides] [--window-days D] [--decimate N]
+"""
+from __future__ import print_function
+
+import argparse
+import calendar
+import hashlib
+import multiprocessing
+import sqlite3
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import numpy as np
+from pytides import constituent
+from pytides.tide import Tide
+
+from tide_engine import CONSTITUENTS, PARTITION, TideEngine
+from tide_store import TideStore, write_store
+
+# Connection and fit options of a pool worker, set by _init_worker.
+_WORKER_DB = None
+_WORKER_OPTIONS = {}
+
+# lstsq solves the linear problem directly, pytides runs Tide.decompose.
+METHODS = ('lstsq', 'pytides')
+
+# Rows of the design matrix built at a time.
+FIT_CHUNK = 1 << 16
+
+# Row layout of a station series read straight from sqlite.
+SERIES_DTYPE = np.dtype([('date', np.int64), ('mm', np.float64)])
+
+
+def fit_series(dates, heights, method='lstsq', window_days=None, decimate=1):
+    """Fit a model to a window of a series.
+    :param dates: sorted epoch seconds UTC -- ndarray
+    :param heights: heights in mm -- ndarray
+    :param method: one of METHODS
+    :param window_days: fit only the days before the last sample (default:
+        the whole series)
+    :param decimate: fit every n-th sample of the window
+    :returns: Pytides model, residual RMS in mm over the whole window
+    """
+    if method not in METHODS:
+        raise ValueError('Unknown fit method %s, expected one of %s' %
+                         (method, ', '.join(METHODS)))
+
+    if window_days is not None:
+        first = np.searchsorted(dates, dates[-1] - window_days * 86400.0)
+        dates = dates[first:]
+        heights = heights[first:]
+
+    sample_dates = dates[::decimate]
+    sample_heights = heights[::decimate]
+    if method == 'pytides':
+        model = Tide.decompose(
+            sample_heights, (sample_dates - sample_dates[0]) / 3600.0,
+            t0=datetime.utcfromtimestamp(sample_dates[0])).model
+    else:
+        model = fit_harmonics(sample_dates, sample_heights)
+
+    return model, residual_rms(model, dates, heights)
+
+
+def fit_harmonics(dates, heights, constituents=None, n_period=2,
+                  chunk=FIT_CHUNK):
+    """Least squares harmonic fit, the linear equivalent of Tide.decompose.
+    The mean is taken out, constituents completing fewer than n_period
+    cycles are left out, and node factors are held for 240 hour partitions,
+    all as in Tide.decompose.
+    :param dates: sorted epoch seconds UTC -- ndarray
+    :param heights: heights in mm -- ndarray
+    :param constituents: pytides constituents (default: constituent.noaa)
+    :returns: Pytides model
+    """
+    t0 = datetime.utcfromtimestamp(dates[0])
+    hours = (dates - dates[0]) / 3600.0
+    z0 = np.mean(heights)
+
+    # As in Tide.decompose, without duplicates and the mean level.
+    constituents = [c for c in OrderedDict.fromkeys(constituents or
+                                                    constituent.noaa)
+                    if not c == constituent._Z0]
+    speed, phi, f = _arguments(constituents, t0, hours)
+    fitted = 360.0 * n_period < hours[-1] * np.degrees(speed[0])
+    constituents = [c for (c, keep) in zip(constituents, fitted) if keep]
+    speed, phi, f = speed[:, fitted], phi[:, fitted], f[:, fitted]
+    n = len(constituents)
+
+    # Normal equations, accumulated a block of rows at a time.
+    normal = np.zeros((2 * n, 2 * n))
+    rhs = np.zeros(2 * n)
+    for lo in range(0, len(hours), chunk):
+        design = _design(hours[lo:lo + chunk], speed, phi, f)
+        normal += np.dot(design.T, design)
+        rhs += np.dot(design.T, heights[lo:lo + chunk] - z0)
+    solution = np.linalg.lstsq(normal, rhs, rcond=None)[0]
+
+    model = np.zeros(1 + n, dtype=Tide.dtype)
+    model[0] = (constituent._Z0, z0, 0)
+    model[1:]['constituent'] = constituents
+    model[1:]['amplitude'] = np.hypot(solution[:n], solution[n:])
+    model[1:]['phase'] = np.mod(np.degrees(np.arctan2(solution[n:],
+                                                      solution[:n])), 360.0)
+
+    return model
+
+
+def residual_rms(model, dates, heights, chunk=FIT_CHUNK):
+    """Root mean square difference between a model and a series.
+    :param model: Pytides model
+    :returns: RMS in mm -- float
+    """
+    t0 = datetime.utcfromtimestamp(dates[0])
+    hours = (dates - dates[0]) / 3600.0
+
+    z0 = sum(a for (c, a, _) in model if c == constituent._Z0)
+    model = [row for row in model if not row[0] == constituent._Z0]
+    speed, phi, f = _arguments([c for (c, _, _) in model], t0, hours)
+    amplitude = np.array([a for (_, a, _) in model])
+    phase = np.radians([p for (_, _, p) in model])
+    coefficients = np.append(amplitude * np.cos(phase),
+                             amplitude * np.sin(phase))
+
+    squares = 0.0
+    for lo in range(0, len(hours), chunk):
+        design = _design(hours[lo:lo + chunk], speed, phi, f)
+        residual = heights[lo:lo + chunk] - z0 - np.dot(design, coefficients)
+        squares += np.dot(residual, residual)
+
+    return float(np.sqrt(squares / len(hours)))
+
+
+def _arguments(constituents, t0, hours):
+    """Speed, V0 + u and f of the constituents for each 240 hour partition
+    after t0, as Tide.decompose holds them.
+    :returns: (partitions x constituents) arrays, speeds in rad/hour
+    """
+    engine = TideEngine([], None, None, constituents)
+    count = int(hours[-1] // PARTITION) + 1
+    return engine.arguments(
+        [t0] * count,
+        [t0 + timedelta(hours=(i + 0.5) * PARTITION) for i in range(count)])
+
+
+def _design(hours, speed, phi, f):
+    """Design matrix of a block of rows, f cos(arg) then f sin(arg) for each
+    constituent, with the arguments of each row's partition.
+    """
+    partition = (hours // PARTITION).astype(int)
+    arg = speed[partition] * hours[:, np.newaxis] + phi[partition]
+    return np.hstack((f[partition] * np.cos(arg), f[partition] * np.sin(arg)))
+
+
+def read_series(cursor, station_id, start=None, end=None):
+    """Read a station's series as columns.
+    The rows go straight from the cursor into one structured array, so no
+    per-row Python objects are kept.
+    :param cursor: sqlite cursor
+    :param station_id: The station id of interest
+    :param start: first time to include, datetime or epoch seconds UTC
+    :param end: time to stop before, datetime or epoch seconds UTC
+    :returns: epoch seconds UTC (int64), heights in mm (float64) -- ndarrays;
+        dates.astype('datetime64[s]') gives datetimes
+    """
+    query = 'select date,mm from fdh where station=?'
+    params = [str(station_id)]
+    if start is not None:
+        query += ' and date>=?'
+        params.append(_epoch(start))
+    if end is not None:
+        query += ' and date<?'
+        params.append(_epoch(end))
+
+    # A cursor of its own returning plain tuples, whatever the connection's
+    # row_factory; np.fromiter cannot read sqlite3.Row.
+    rows = cursor.connection.cursor()
+    rows.row_factory = None
+    rows.execute(query + ' order by date', params)
+    series = np.fromiter(rows, dtype=SERIES_DTYPE)
+
+    return series['date'], series['mm']
+
+
+def _epoch(t):
+    if isinstance(t, datetime):
+        return calendar.timegm(t.utctimetuple())
+    return int(t)
+
+
+def fingerprints(cursor):
+    """Summarize every station's series in one pass over fdh.
+    :param cursor: sqlite cursor
+    :returns: Dict -- {'station_id': fingerprint, ...}
+    """
+    cursor.execute('select station, count(*), min(date), max(date), sum(mm) '
+                   'from fdh group by station;')
+
+    return dict((row[0], hashlib.sha1(repr(tuple(row[1:]))
+                                      .encode('utf-8')).hexdigest())
+                for row in cursor.fetchall())
+
+
+def fit_station(station):
+    """Fit one station in a pool worker.
+    Constituents are returned by name, pytides constituents do not pickle.
+    :returns: station, [(name, amplitude, phase), ...] or None, residual RMS
+        in mm, seconds, error message or None
+    """
+    start = time.time()
+    try:
+        dates, heights = read_series(_WORKER_DB.cursor(), station)
+        fitted, rms = fit_series(dates, heights, **_WORKER_OPTIONS)
+        model = [(c.name, amplitude, phase)
+                 for (c, amplitude, phase) in fitted]
+        error = None
+    except Exception as e:
+        model = None
+        rms = None
+        error = '%s: %s' % (type(e).__name__, e)
+
+    return station, model, rms, time.time() - start, error
+
+
+def _init_worker(db_file, options=None):
+    global _WORKER_DB, _WORKER_OPTIONS
+    _WORKER_DB = sqlite3.connect(db_file)
+    _WORKER_OPTIONS = options or {}
+
+
+def _to_model(rows):
+    """Rebuild a pytides model array from (name, amplitude, phase) rows.
+    """
+    by_name = dict((c.name, c) for c in CONSTITUENTS)
+
+    model = np.zeros(len(rows), dtype=Tide.dtype)
+    model['constituent'] = [by_name[name] for (name, _, _) in rows]
+    model['amplitude'] = [amplitude for (_, amplitude, _) in rows]
+    model['phase'] = [phase for (_, _, phase) in rows]
+
+    return model
+
+
+def fit_models(db_file, store_path, incremental=False, processes=None,
+               method='lstsq', window_days=None, decimate=1):
+    """Fit station models and write them to a tide store.
+    :param db_file: sqlite file with the stations and fdh tables
+    :param store_path: tide_store directory to write
+    :param incremental: reuse the models of stations whose fingerprint is
+        unchanged in the existing store
+    :param processes: pool size (default: one per core)
+    :param method: one of METHODS
+    :param window_days: fit only the most recent days of each series
+    :param decimate: fit every n-th sample
+    :returns: List -- [{'station', 'rms', 'seconds', 'error'}, ...] for
+        every station that was fitted
+    """
+    conn = sqlite3.connect(db_file)
+    cursor = conn.cursor()
+    cursor.execute('select station from stations;')
+    stations = [row[0] for row in cursor.fetchall()]
+    current = fingerprints(cursor)
+    conn.close()
+
+    models = {}
+    previous = {}
+    if incremental:
+        try:
+            store = TideStore(store_path)
+            previous = store.fingerprints
+        except IOError:
+            store = None
+
+        for station in stations:
+            if station in previous and previous[station] == current.get(station):
+                models[station] = (store.model(station) if station in store
+                                   else None)
+
+    todo = [s for s in stations if s not in models]
+    print('Fitting %d of %d stations' % (len(todo), len(stations)))
+
+    report = []
+    options = {'method': method, 'window_days': window_days,
+               'decimate': decimate}
+    pool = multiprocessing.Pool(processes, _init_worker, (db_file, options))
+    try:
+        for station, rows, rms, seconds, error in pool.imap_unordered(
+                fit_station, todo):
+            models[station] = _to_model(rows) if rows is not None else None
+            report.append({'station': station, 'rms': rms,
+                           'seconds': seconds, 'error': error})
+            print('%s: %.2fs%s' % (station, seconds,
+                                   ' failed, %s' % error if error
+                                   else ', RMS %.1f mm' % rms))
+    finally:
+        pool.close()
+        pool.join()
+
+    write_store(store_path, models,
+                dict((s, current.get(s)) for s in stations))
+
+    failed = sum(1 for r in report if r['error'])
+    rms = [r['rms'] for r in report if r['rms'] is not None]
+    print('Fitted %d stations, %d failed, %.1fs of fitting%s' %
+          (len(report), failed, sum(r['seconds'] for r in report),
+           ', median RMS %.1f mm' % np.median(rms) if rms else ''))
+
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fit station tide models.')
+    parser.add_argument('db_file', help='sqlite gauge database')
+    parser.add_argument('store', help='tide store directory to write')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only refit stations whose data changed')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='worker processes (default: one per core)')
+    parser.add_argument('--method', choices=METHODS, default='lstsq',
+                        help='fitting method (default: lstsq)')
+    parser.add_argument('--window-days', type=float, default=None,
+                        help='fit only the most recent days of each series')
+    parser.add_argument('--decimate', type=int, default=1,
+                        help='fit every n-th sample (default: 1)')
+    args = parser.parse_args()
+
+    fit_models(args.db_file, args.store, args.incremental, args.processes,
+               args.method, args.window_days, args.decimate)
@@ -0,0 +1,295 @@
+"""A long running tide prediction service.
+
+Point queries arriving concurrently are collected into micro-batches and
+answered with one vectorized call, so the models and station index are
+loaded once and each query costs milliseconds.
+
+    GET  /tide?lat=21.3&lon=-157.9&dtg=2016-05-03-13-42
+    POST /tides   {"points": [{"lat": .., "lon": .., "dtg": ..}, ...]}
+    GET  /health
+    GET  /metrics
+
+Started with ``python shoreline-task.py serve``.
+"""
+from __future__ import print_function
+
+import json
+import threading
+import time
+from datetime import datetime
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+# Largest batch, and the longest a query waits for others to join it.
+# Queries arriving while a batch is predicted queue up for the next one, so
+# under load batches form without waiting.
+MAX_BATCH = 256
+MAX_WAIT = 0.001
+
+# Date time group of a query, as shoreline-task takes it.
+DTG_FORMAT = '%Y-%m-%d-%H-%M'
+
+
+class _Pending(object):
+    """A query waiting for its batch.
+    """
+
+    def __init__(self, point):
+        self.point = point
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatcher(object):
+    """Collects single queries from many threads into batch calls.
+    """
+
+    def __init__(self, batch, max_batch=MAX_BATCH, max_wait=MAX_WAIT):
+        """
+        :param batch: function of lats, lons, dtgs returning one result per
+            point, e.g. tide_coordination_batch
+        :param max_batch: most points in one call
+        :param max_wait: seconds the first query of a batch waits for more
+        """
+        self.batch = batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+
+        self.queries = 0
+        self.batches = 0
+        self.errors = 0
+        self.largest = 0
+        self.batch_seconds = 0.0
+
+        self._queue = []
+        self._ready = threading.Condition()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __call__(self, lat, lon, dtg=None):
+        """Result for one point, computed in the next batch.
+        :raises: whatever the batch function raised
+        """
+        pending = _Pending((lat, lon, dtg))
+        with self._ready:
+            self._queue.append(pending)
+            self._ready.notify()
+
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _run(self):
+        while True:
+            with self._ready:
+                while not self._queue:
+                    self._ready.wait()
+
+                # Give other queries a moment to join the first one.
+                deadline = time.time() + self.max_wait
+                while len(self._queue) < self.max_batch:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._ready.wait(remaining)
+
+                batch = self._queue[:self.max_batch]
+                del self._queue[:self.max_batch]
+
+            self._call(batch)
+
+    def _call(self, batch):
+        start = time.time()
+        errors = 0
+        try:
+            lats, lons, dtgs = zip(*[p.point for p in batch])
+            results = _check(self.batch(list(lats), list(lons), list(dtgs)),
+                             len(batch))
+            for pending, result in zip(batch, results):
+                pending.result = result
+        except Exception as e:
+            if len(batch) == 1:
+                errors += 1
+                batch[0].error = e
+            else:
+                # Retry one query at a time, so only the queries that fail
+                # get an error.
+                errors += sum(not self._call_one(p) for p in batch)
+
+        # Counters are read by /metrics on the request threads.
+        with self._ready:
+            self.errors += errors
+            self.queries += len(batch)
+            self.batches += 1
+            self.largest = max(self.largest, len(batch))
+            self.batch_seconds += time.time() - start
+
+        for pending in batch:
+            pending.done.set()
+
+    def _call_one(self, pending):
+        """Compute one query on its own.
+        :returns: whether it succeeded
+        """
+        lat, lon, dtg = pending.point
+        try:
+            pending.result = _check(self.batch([lat], [lon], [dtg]), 1)[0]
+        except Exception as e:
+            pending.error = e
+            return False
+        return True
+
+    def stats(self):
+        """
+        :returns: Dict -- queries, batches, failed queries (errors), largest
+            and mean batch size, mean seconds per batch
+        """
+        with self._ready:
+            batches = max(self.batches, 1)
+            return {
+                'queries': self.queries,
+                'batches': self.batches,
+                'errors': self.errors,
+                'largest_batch': self.largest,
+                'mean_batch': float(self.queries) / batches,
+                'mean_batch_seconds': self.batch_seconds / batches
+            }
+
+
+def _check(results, count):
+    """The results of a batch call, which must hold one per query.
+    :raises ValueError: if they do not
+    """
+    results = list(results)
+    if len(results) != count:
+        raise ValueError('Batch returned %d results for %d queries' %
+                         (len(results), count))
+    return results
+
+
+class TideService(ThreadingMixIn, HTTPServer):
+    """HTTP front end of a MicroBatcher, one thread per connection.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, batcher, metrics=None):
+        """
+        :param address: (host, port)
+        :param batcher: MicroBatcher
+        :param metrics: optional function returning a Dict of further
+            metrics, e.g. cache_stats
+        """
+        HTTPServer.__init__(self, address, _Handler)
+        self.batcher = batcher
+        self.metrics = metrics
+        self.started = time.time()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep connections open between queries, and send each response in one
+    # write without waiting on Nagle's algorithm.
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    wbufsize = -1
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/tide':
+            query = parse_qs(url.query)
+            try:
+                lat = float(query['lat'][0])
+                lon = float(query['lon'][0])
+            except (KeyError, ValueError):
+                return self._send(400, {'error': 'lat and lon are required'})
+            dtg = query.get('dtg', [None])[0]
+            if not _valid_dtg(dtg):
+                return self._send(400, {'error': 'dtg must be Y-m-d-H-M'})
+            return self._answer(lambda: self.server.batcher(lat, lon, dtg))
+
+        if url.path == '/health':
+            return self._send(200, {
+                'status': 'ok',
+                'uptime_seconds': time.time() - self.server.started
+            })
+
+        if url.path == '/metrics':
+            metrics = {'batching': self.server.batcher.stats()}
+            if self.server.metrics is not None:
+                metrics.update(self.server.metrics())
+            return self._send(200, metrics)
+
+        self._send(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/tides':
+            return self._send(404, {'error': 'not found'})
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            points = json.loads(self.rfile.read(length).decode('utf-8'))['points']
+            lats = [float(p['lat']) for p in points]
+            lons = [float(p['lon']) for p in points]
+            dtgs = [p.get('dtg') for p in points]
+            if not all(_valid_dtg(dtg) for dtg in dtgs):
+                raise ValueError('dtg must be Y-m-d-H-M')
+        except (KeyError, TypeError, ValueError):
+            return self._send(400, {'error': 'expected {"points": '
+                                             '[{"lat", "lon", "dtg"}, ...]}'})
+
+        # A request that is already a batch skips the batcher.
+        self._answer(lambda: self.server.batcher.batch(lats, lons, dtgs))
+
+    def _answer(self, compute):
+        try:
+            result = compute()
+        except Exception as e:
+            return self._send(500, {'error': '%s: %s' % (type(e).__name__, e)})
+        self._send(200, result)
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def _valid_dtg(dtg):
+    """Whether a query's date time group is absent or parses.
+    """
+    if dtg is None:
+        return True
+    try:
+        datetime.strptime(dtg, DTG_FORMAT)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+def serve(batch, host='127.0.0.1', port=8080, metrics=None,
+          max_batch=MAX_BATCH, max_wait=MAX_WAIT):
+    """Run the service until interrupted.
+    """
+    server = TideService((host, port),
+                         MicroBatcher(batch, max_batch, max_wait), metrics)
+    print('Serving tides on http://%s:%d' % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
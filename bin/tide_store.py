@@ -0,0 +1,198 @@
+"""Versioned on-disk store of fitted tide models.
+
+A store is a directory holding
+
+    index.json        format version, constituent names, station ids,
+                      the name of the coefficients file and optionally the
+                      fingerprint of each station's data
+    coefficients-<id>.npy
+                      (stations x 2 x constituents) float64 array of
+                      amplitude (mm) and phase (degrees) rows
+
+Every station shares the constituent table, so the array is read through a
+memory map and only the pages of the stations actually queried are loaded.
+A store is rewritten under new file names and switched over by renaming the
+index, so a running reader keeps the files it mapped.
+Nothing is pickled, so reading a store needs neither dill nor the pickled
+pytides constituent objects.
+
+Convert an existing dill pickle of models with
+
+    python tide_store.py tidemodel.pkl tidemodel
+"""
+from __future__ import print_function
+
+import json
+import os
+import sys
+import uuid
+
+import numpy as np
+from pytides.tide import Tide
+
+from tide_engine import CONSTITUENTS, TideEngine
+
+VERSION = 1
+
+INDEX_FILE = 'index.json'
+# Coefficients of stores written before the index named its file.
+COEFFICIENTS_FILE = 'coefficients.npy'
+
+
+def data_file(prefix):
+    """A new file name for the data of a store or table, so writing it never
+    truncates a file a reader has mapped.
+    :returns: file name -- String
+    """
+    return '%s-%s.npy' % (prefix, uuid.uuid4().hex)
+
+
+def publish(path, index, key, default):
+    """Replace the index of a store or table and remove the data files no
+    longer in use.
+    The index is written under a temporary name and renamed over the old one,
+    so a reader sees either the old or the new index, each with its own data
+    file.  The data file of the old index is kept for readers that have just
+    read it.
+    :param path: directory
+    :param index: Dict -- index naming its data file under key
+    :param key: index entry of the data file name
+    :param default: data file name of indexes without the entry; data files
+        are the .npy files starting with its stem
+    """
+    filename = os.path.join(path, INDEX_FILE)
+    try:
+        with open(filename) as f:
+            previous = json.load(f).get(key, default)
+    except (IOError, ValueError):
+        previous = None
+
+    temporary = os.path.join(path, '.%s.%s' % (INDEX_FILE, uuid.uuid4().hex))
+    with open(temporary, 'w') as f:
+        json.dump(index, f)
+    os.rename(temporary, filename)
+
+    stem = os.path.splitext(default)[0]
+    for name in os.listdir(path):
+        if (name.startswith(stem) and name.endswith('.npy') and
+                name not in (index[key], previous)):
+            try:
+                os.remove(os.path.join(path, name))
+            except OSError:
+                pass
+
+
+def write_store(path, models, fingerprints=None):
+    """Write fitted models to a store.
+    :param path: store directory, created if missing
+    :param models: Dict -- {'station_id': Tide or model array, ...}; stations
+        without a model (None) are left out.
+    :param fingerprints: Dict -- {'station_id': fingerprint, ...} of the data
+        each model was fitted to, see tide_fit.
+    """
+    names = dict((c.name, i) for (i, c) in enumerate(CONSTITUENTS))
+    stations = sorted(k for (k, v) in models.items() if v is not None)
+
+    coefficients = np.zeros((len(stations), 2, len(CONSTITUENTS)))
+    for row, station in enumerate(stations):
+        model = models[station]
+        if isinstance(model, Tide):
+            model = model.model
+        for c, amplitude, phase in model:
+            coefficients[row, :, names[c.name]] = amplitude, phase
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    name = data_file('coefficients')
+    np.save(os.path.join(path, name), coefficients)
+
+    # The index goes last, a store without one is incomplete.
+    publish(path, {
+        'version': VERSION,
+        'constituents': [c.name for c in CONSTITUENTS],
+        'stations': stations,
+        'coefficients': name,
+        'fingerprints': sorted((fingerprints or {}).items())
+    }, 'coefficients', COEFFICIENTS_FILE)
+
+
+class TideStore(object):
+    """Read only view of a store.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: store directory
+        :raises IOError: if the store does not exist
+        :raises ValueError: if the store has an unknown format version
+        """
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            index = json.load(f)
+
+        if index.get('version') != VERSION:
+            raise ValueError('Unsupported tide store version %s in %s.' %
+                             (index.get('version'), path))
+
+        by_name = dict((c.name, c) for c in CONSTITUENTS)
+        self.path = path
+        self.constituents = [by_name[name] for name in index['constituents']]
+        self.stations = index['stations']
+        self.rows = dict((s, i) for (i, s) in enumerate(self.stations))
+        self.fingerprints = dict(
+            (s, f) for (s, f) in index.get('fingerprints', []))
+
+        coefficients = np.load(
+            os.path.join(path, index.get('coefficients', COEFFICIENTS_FILE)),
+            mmap_mode='r')
+        self.amplitude = coefficients[:, 0, :]
+        self.phase = coefficients[:, 1, :]
+
+    def __contains__(self, station):
+        return station in self.rows
+
+    def __len__(self):
+        return len(self.stations)
+
+    def __getitem__(self, station):
+        """A pytides Tide for one station, built from its row alone.
+        :raises KeyError: if the station has no model
+        """
+        return Tide(model=self.model(station), radians=False)
+
+    def model(self, station):
+        """The pytides model array for one station.
+        :returns: ndarray of Tide.dtype
+        """
+        row = self.rows[station]
+        amplitude = np.array(self.amplitude[row])
+        phase = np.array(self.phase[row])
+
+        # Keep the mean level even when it is zero.
+        used = amplitude != 0
+        used[0] = True
+
+        model = np.zeros(used.sum(), dtype=Tide.dtype)
+        model['constituent'] = [c for (c, u) in zip(self.constituents, used)
+                                if u]
+        model['amplitude'] = amplitude[used]
+        model['phase'] = phase[used]
+
+        return model
+
+    def engine(self):
+        """A TideEngine reading straight from the memory map.
+        """
+        return TideEngine(self.stations, self.amplitude, self.phase,
+                          self.constituents)
+
+
+if __name__ == '__main__':
+    import dill
+
+    if len(sys.argv) != 3:
+        print('usage: %s tidemodel.pkl store_dir' % sys.argv[0])
+        sys.exit(1)
+
+    with open(sys.argv[1], 'rb') as tm:
+        write_store(sys.argv[2], dill.load(tm))
@@ -1,20 +1,26 @@
-import bftideprediction.data.to_db_fhd as to_db_fhd
+import data.to_db_fhd as to_db_fhd
 import os
+import sqlite3
 
-def test_to_db_fhd():
-    test_file = 'test/fixtures/fdh_test.sqlite'
-    if os.path.exists(test_file):
-        os.remove(test_file)
-    to_db_fhd.to_db_fhd(test_file, 'test/fixtures')
+
+def test_to_db_fhd(tmpdir):
+    tmpdir.join('h001a.csv').write('2013,11,14,8,599\n2013,11,14,9,612\nbad\n')
+    tmpdir.join('h002a.csv').write('2013,11,14,8,1001\n')
+    test_file = str(tmpdir.join('fdh_test.sqlite'))
+    to_db_fhd.to_db_fhd(test_file, str(tmpdir))
     assert os.path.exists(test_file)
 
+    conn = sqlite3.connect(test_file)
+    rows = conn.execute('select station, date, mm from fdh '
+                        'where station=? order by date', ('1a',)).fetchall()
+    assert rows == [('1a', 1384416000, 599.0), ('1a', 1384419600, 612.0)]
+    plan = conn.execute('explain query plan select date, mm from fdh '
+                        'where station=? order by date', ('1a',)).fetchall()
+    assert 'fdh_station_date' in str(plan)
 
-def test_to_db_fhd_except():
-    test_file = 'test/fixtures/fdh_test.sqlite'
-    if os.path.exists(test_file):
-        os.remove(test_file)
+
+def test_to_db_fhd_except(tmpdir):
+    test_file = str(tmpdir.join('fdh_test.sqlite'))
     to_db_fhd.to_db_fhd(test_file, 'NOTREAL/NOTREAL/POSSIBLYREAL')
     if os.path.exists(test_file):
         os.remove(test_file)
-
-
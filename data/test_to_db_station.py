@@ -1,21 +1,36 @@
-import bftideprediction.data.to_db_station as to_db_station
+import data.to_db_station as to_db_station
 import os
+import sqlite3
 
-def test_to_db_fhd():
-    test_file = 'test/fixtures/stations/fdh_test2.sqlite'
-    if os.path.exists(test_file):
-        os.remove(test_file)
-    to_db_station.to_db_station(test_file, 'test/fixtures/stations')
+
+def test_to_db_station(tmpdir):
+    tmpdir.join('stations.csv').write(
+        'a,b,c,d,e,21.3,202.1,h001a.csv\n'
+        'a,b,c,d,e,21.3,-157.9,h001a.csv\n'
+        'a,b,c,d,e,95.0,10.0,h002a.csv\n'
+        'a,b,c,d,e,lat,lon,header.csv\n'
+        'a,b,c,d,e,-33.9,18.4,h003a.csv\n')
+    test_file = str(tmpdir.join('fdh_test2.sqlite'))
+    to_db_station.to_db_station(test_file, str(tmpdir))
     assert os.path.exists(test_file)
-    if os.path.exists(test_file):
-        os.remove(test_file)
 
+    conn = sqlite3.connect(test_file)
+    rows = conn.execute('select station, lat, lon, x * x + y * y + z * z '
+                        'from stations order by id').fetchall()
+    assert [r[0] for r in rows] == ['1a', '3a']
+    assert abs(rows[0][2] - -157.9) < 1e-9
+    assert all(abs(r[3] - 1) < 1e-12 for r in rows)
 
-def test_to_db_fhd_except():
-    test_file = 'test/fixtures/stations/fdh_test2.sqlite'
+    found = conn.execute('select s.station from stations s '
+                         'join stations_rtree r on s.id = r.id '
+                         'where r.min_lat > 0').fetchall()
+    assert found == [('1a',)]
     if os.path.exists(test_file):
         os.remove(test_file)
+
+
+def test_to_db_station_except(tmpdir):
+    test_file = str(tmpdir.join('fdh_test2.sqlite'))
     to_db_station.to_db_station(test_file, 'NOTREAL/NOTREAL/POSSIBLYREAL')
     if os.path.exists(test_file):
         os.remove(test_file)
-
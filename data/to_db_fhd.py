@@ -10,36 +10,58 @@ http://www.apache.org/licenses/LICENSE-2.0
 Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
 """
 
-import glob, csv, sqlite3, os, sys
+from __future__ import print_function
+
+import glob, csv, sqlite3, os, sys, calendar
+from posixpath import basename
+
+
+def station_id(path):
+    # Same id to_db_station derives from the data file name of a station.
+    return os.path.splitext(basename(path))[0][3:]
+
+
+def read_fhd(path, station):
+    """Stream the rows of one hourly gauge CSV.
+    :returns: generator of (station, epoch seconds UTC, mm) tuples
+    """
+    with open(path, 'rU') as f:
+        for row in csv.reader(f, delimiter=','):
+            # 2013,11,14,8,599
+            # Year, Month, Day, Hour, tide level (mm)
+            try:
+                year, month, day, hour = [int(v) for v in row[:4]]
+                date = calendar.timegm((year, month, day, hour, 0, 0))
+                yield station, date, float(row[4])
+            except (IndexError, ValueError):
+                print(row)
+                continue
 
 
 def to_db_fhd(out_db, folder_csv):
     conn = sqlite3.connect(out_db)
-    curs = conn.cursor()
-    curs.execute("CREATE TABLE FDH (id INTEGER PRIMARY KEY, date DATE, mm FLOAT);")
+    conn.execute("CREATE TABLE IF NOT EXISTS FDH "
+                 "(id INTEGER PRIMARY KEY, station STRING, date INTEGER, mm REAL);")
+    conn.execute("DROP INDEX IF EXISTS fdh_station_date;")
     search_string = os.path.join(folder_csv, '*csv')
     files = glob.glob(search_string)
 
     for f in files:
-        reader = None
+        # One transaction per file, rolled back if the file can't be read.
         try:
-            reader = csv.reader(open(f, 'rU'), delimiter=',')
-        except (csv.Error, UnicodeDecodeError):
+            with conn:
+                conn.executemany("INSERT INTO FDH (station, date, mm) VALUES (?, ?, ?);",
+                                 read_fhd(f, station_id(f)))
+        except (csv.Error, IOError, UnicodeDecodeError):
             print("error", f)
             continue
 
-        for row in reader:
-            # 2013,11,14,8,599
-            # Year, Month, Day, Hour, tide level (mm)
-            try:
-                date = '-'.join(row[:4])
-                to_db = [unicode(date, "utf8"), unicode(row[4], "utf8")]
-                curs.execute("INSERT INTO FDH (date, mm) VALUES (?, ?);", to_db)
-            except IndexError:
-                print(row)
-                continue
-
-        conn.commit()
+    # Indexing once after the load is much cheaper than maintaining the
+    # index on every insert.
+    conn.execute("CREATE INDEX fdh_station_date ON FDH (station, date);")
+    conn.commit()
     conn.close()
 
 
+if __name__ == '__main__':
+    to_db_fhd(sys.argv[1], sys.argv[2])
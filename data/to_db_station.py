@@ -10,74 +10,112 @@ http://www.apache.org/licenses/LICENSE-2.0
 Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
 """
 
+from __future__ import print_function
+
 import glob
 import csv
 import sqlite3
 import os
 import math
+import sys
 from posixpath import basename
 
 
-def to_db_station(out_db, sealevelstations_csv):
-    conn = sqlite3.connect(out_db)
-    curs = conn.cursor()
-    curs.execute("""
-                 CREATE TABLE STATIONS \
-                 (id INTEGER PRIMARY KEY, \
-                 lat FLOAT, \
-                 lon FLOAT, \
-                 cos_lat FLOAT, \
-                 sin_lat FLOAT, \
-                 cos_lon FLOAT, \
-                 sin_lon FLOAT, \
-                 station STRING);""")
-
-    search_string = os.path.join(sealevelstations_csv, '*csv')    
-    files = glob.glob(search_string)
+def read_stations(files):
+    """Stream valid, distinct stations from station list CSVs.
+    :returns: generator of (lat, lon, cos_lat, sin_lat, cos_lon, sin_lon,
+        x, y, z, station) tuples
+    """
+    seen = set()
 
     for f in files:
-        reader = None
+        # Station lists are small, read each whole so a bad file is
+        # skipped before any of its rows are inserted.
         try:
-            reader = csv.reader(open(f, 'rU'), delimiter=',')
-
-        except (csv.Error, UnicodeDecodeError):
+            with open(f, 'rU') as fh:
+                rows = list(csv.reader(fh, delimiter=','))
+        except (csv.Error, IOError, UnicodeDecodeError):
             print("error", f)
             continue
 
-        for row in reader:
-
+        for row in rows:
             try:
                 station = os.path.splitext(basename(row[-1]))[0][3:]
                 lat = float(row[5])
                 lon = float(row[6])
+            except (IndexError, ValueError):
+                print(row)
+                continue
 
-                cos_lat = math.cos(lat * math.pi / 180.0)
-                sin_lat = math.sin(lat * math.pi / 180.0)
+            # Some station lists give longitudes east in [0, 360).
+            if 180 < lon <= 360:
+                lon -= 360
 
-                cos_lon = math.cos(lon * math.pi / 180.0)
-                sin_lon = math.sin(lon * math.pi / 180.0)
+            if not station or not (-90 <= lat <= 90 and -180 <= lon <= 180):
+                print("invalid", row)
+                continue
 
-                to_db = [
-                    unicode(str(lat), "utf8"),
-                    unicode(str(lon), "utf8"),
+            if station in seen:
+                print("duplicate", row)
+                continue
+            seen.add(station)
 
-                    unicode(str(cos_lat), "utf8"),
-                    unicode(str(sin_lat), "utf8"),
+            cos_lat = math.cos(lat * math.pi / 180.0)
+            sin_lat = math.sin(lat * math.pi / 180.0)
 
-                    unicode(str(cos_lon), "utf8"),
-                    unicode(str(sin_lon), "utf8"),
+            cos_lon = math.cos(lon * math.pi / 180.0)
+            sin_lon = math.sin(lon * math.pi / 180.0)
 
-                    unicode(station, "utf8")
-                ]
+            # Unit vector on the sphere, what the station index searches.
+            yield (lat, lon, cos_lat, sin_lat, cos_lon, sin_lon,
+                   cos_lat * cos_lon, cos_lat * sin_lon, sin_lat,
+                   station)
 
-                curs.execute("""
-                             INSERT INTO STATIONS \
-                             (lat, lon, cos_lat, sin_lat,\
-                             cos_lon, sin_lon, station) \
-                             VALUES (?, ?, ?, ?, ?, ?, ?);\
-                             """, to_db)
-            except IndexError:
-                print(row)
-                continue
 
-            conn.commit()
+def to_db_station(out_db, sealevelstations_csv, rtree=True):
+    conn = sqlite3.connect(out_db)
+    conn.execute("""
+                 CREATE TABLE IF NOT EXISTS STATIONS \
+                 (id INTEGER PRIMARY KEY, \
+                 lat REAL, \
+                 lon REAL, \
+                 cos_lat REAL, \
+                 sin_lat REAL, \
+                 cos_lon REAL, \
+                 sin_lon REAL, \
+                 x REAL, \
+                 y REAL, \
+                 z REAL, \
+                 station STRING UNIQUE);""")
+
+    search_string = os.path.join(sealevelstations_csv, '*csv')
+    files = glob.glob(search_string)
+
+    # One transaction for the whole run.
+    with conn:
+        conn.executemany("""
+                         INSERT OR IGNORE INTO STATIONS \
+                         (lat, lon, cos_lat, sin_lat,\
+                         cos_lon, sin_lon, x, y, z, station) \
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);\
+                         """, read_stations(files))
+
+    if rtree:
+        # Bounding box index for coarse prefiltering, stations are points.
+        try:
+            with conn:
+                conn.execute("DROP TABLE IF EXISTS stations_rtree;")
+                conn.execute("""
+                             CREATE VIRTUAL TABLE stations_rtree USING rtree \
+                             (id, min_lat, max_lat, min_lon, max_lon);""")
+                conn.execute("""
+                             INSERT INTO stations_rtree \
+                             SELECT id, lat, lat, lon, lon FROM stations;""")
+        except sqlite3.OperationalError as e:
+            print("no rtree index", e)
+
+    conn.close()
+
+
+if __name__ == '__main__':
+    to_db_station(sys.argv[1], sys.argv[2])